@@ -1,11 +1,48 @@
-from typing import Optional, Any
-from databaseObjects import testObjects
+import json
+import threading
+import weakref
+from contextlib import nullcontext
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from bisect import bisect_left, bisect_right
+from itertools import count
+from time import perf_counter_ns
+from typing import Optional, Any, Iterator
+from cascade import captureSubtree, restoreSubtree
+from changeFeed import deferredPublishes
+from databaseObjects import LeafNode, testObjects, ownerIndex, ownerRegistry
+from indexes import findIds, unindexObject
+from locking import locks
+from metrics import RequestMetrics, latencyBuckets
+from snapshots import Missing, Snapshot
+
+metricsPath = "_metrics"  # a get on this path returns the server's metrics instead of anything in the database
 
 
 class ApiServer:
 
-    def __init__(self, database: dict[str, Any]):
+    def __init__(self, database: dict[str, Any], name: str = ""):
         self.database = database  # create a database attribute for
+        self.name = name  # used to tell the servers apart in logs
+        self.writeAheadLog: Optional[Any] = None  # anything with an append(record) method, every successful write is sent to it
+        self.batchLog = threading.local()  # holds the writes of an atomic batch on its own thread until it is applied
+        self.metrics: Optional[RequestMetrics] = RequestMetrics()  # set to None to switch metrics off completely
+        self.version = 0  # the version of the last change made to the database
+        self.versions = count(1)
+        self.history: dict[int, tuple[dict[str, Any], dict[str, list[tuple[int, Any]]]]] = {}
+        # while snapshots are open the old value of every changed key is kept here against the node it belongs to
+        self.openSnapshots: weakref.WeakSet[Snapshot] = weakref.WeakSet()
+        self.routes: dict[str, Any] = {}  # flat index of every path in the database so lookups never walk the tree
+        self.nodeVersions: dict[str, int] = {}  # the version of the last change to each path or anything below it
+        # leaves are left out of both as there is one per access token, lookupNode finds them through their parent
+        self.childOrders: dict[str, Optional[tuple[list[str], list[int]]]] = {}
+        # the keys of each node read a page at a time in the order they were added, next to the sequence number each was
+        # added at so a cursor resumes after the last one it handed out whatever was deleted before it
+        # new children are appended to it and a delete sets it to None so it is built again on the next read
+        self.childSequences: dict[str, dict[str, int]] = {}  # the sequence numbers themselves, kept through a delete
+        self.keySequence = count()
+        self.pendingDeletes: set[str] = set()  # paths whose delete has been accepted but not yet applied to this server
+        for key, node in database.items():
+            self.indexNode(key, node)
 
     @staticmethod
     def generateResponse(code: int, data: dict[str, Any]) -> dict[str, Any]:
@@ -16,72 +53,678 @@ class ApiServer:
         # split paths into a list so we can find the correct object
         return path.split("/")
 
+    @staticmethod
+    def routeTemplate(path: list[str]) -> str:
+        # every other part of a path is an id so customers/x/users becomes customers/{id}/users
+        template = "/{id}/".join(path[::2])
+        return template + "/{id}" if len(path) % 2 == 0 else template
+
+    def enableMetrics(self) -> None:
+        if self.metrics is None:
+            self.metrics = RequestMetrics()
+
+    def disableMetrics(self) -> None:
+        self.metrics = None
+
+    def indexNode(self, path: str, node: Any) -> None:
+        # add a node and everything below it to the route index
+        if node is LeafNode:
+            return
+        self.routes[path] = node
+        self.nodeVersions[path] = self.version
+        if isinstance(node, dict):
+            for key, child in node.items():
+                self.indexNode(f"{path}/{key}", child)
+
+    def unindexNode(self, path: str, node: Any) -> None:
+        # remove a node and everything below it from the route index
+        if node is LeafNode:
+            return
+        self.routes.pop(path, None)
+        self.nodeVersions.pop(path, None)
+        self.childOrders.pop(path, None)
+        self.childSequences.pop(path, None)
+        if isinstance(node, dict):
+            for key, child in node.items():
+                self.unindexNode(f"{path}/{key}", child)
+
+    def recordChange(self, parent: dict[str, Any], keys: Any) -> None:
+        # give the change about to be made a new version and, if any snapshot is open, keep the old values for it
+        self.version = next(self.versions)
+        if self.openSnapshots:
+            changes = self.history.setdefault(id(parent), (parent, {}))[1]
+            for key in keys:
+                changes.setdefault(key, []).append((self.version, parent.get(key, Missing)))
+
+    def touchPath(self, path: str) -> None:
+        # a change to a node is a change to everything above it so the path and each of its ancestors take the version
+        while path:
+            self.nodeVersions[path] = self.version
+            path = path.rpartition("/")[0]
+
+    def snapshot(self) -> Snapshot:
+        # an immutable view of the whole database at the current version, taking one costs the same at any size
+        snapshot = Snapshot(self, self.version)
+        self.openSnapshots.add(snapshot)
+        weakref.finalize(snapshot, self.pruneHistory)
+        return snapshot
+
+    def releaseSnapshot(self, snapshot: Snapshot) -> None:
+        self.openSnapshots.discard(snapshot)
+        self.pruneHistory()
+
+    def pruneHistory(self) -> None:
+        # drop the old values no open snapshot can see any more
+        versions = [snapshot.version for snapshot in list(self.openSnapshots)]
+        if not versions:
+            self.history.clear()
+            return
+        oldest = min(versions)
+        for nodeId, (node, changes) in list(self.history.items()):
+            for key, entries in list(changes.items()):
+                entries[:] = [entry for entry in entries if entry[0] > oldest]
+                if not entries:
+                    del changes[key]
+            if not changes:
+                del self.history[nodeId]
+
+    def attachNode(self, path: str, node: Any, parent: Optional[dict[str, Any]] = None) -> None:
+        # insert a node into the database and the route index in one step
+        # objects pass in the dict they own as the parent so it is relinked if the tree holds an older copy
+        parentPath, _, key = path.rpartition("/")
+        if parent is None:
+            parent = self.routes[parentPath] if parentPath else self.database
+        elif parentPath and self.routes.get(parentPath) is not parent:
+            self.recordChange(parent, (key,))
+            parent[key] = node
+            self.attachNode(parentPath, parent)  # relinking the parent indexes the new node with it
+            return
+        previous = parent.get(key)
+        if previous is not None:
+            self.unindexNode(path, previous)
+        else:
+            sequences = self.childSequences.get(parentPath)
+            if sequences is not None:
+                sequence = sequences[key] = next(self.keySequence)
+                order = self.childOrders.get(parentPath)
+                if order is not None:
+                    order[0].append(key)
+                    order[1].append(sequence)
+        self.recordChange(parent, (key,))
+        parent[key] = node
+        self.indexNode(path, node)
+        self.touchPath(parentPath)
+
+    def attachNodes(self, parentPath: str, nodes: dict[str, Any], parent: Optional[dict[str, Any]] = None) -> None:
+        # insert many children under one node in a single pass, the parent is handled as in attachNode
+        if parent is None:
+            parent = self.routes[parentPath]
+        elif self.routes.get(parentPath) is not parent:
+            self.recordChange(parent, nodes)
+            parent.update(nodes)
+            self.attachNode(parentPath, parent)
+            return
+        for key in nodes.keys() & parent.keys():
+            self.unindexNode(f"{parentPath}/{key}", parent[key])
+        sequences = self.childSequences.get(parentPath)
+        if sequences is not None:
+            order = self.childOrders.get(parentPath)
+            for key in nodes:
+                if key not in parent:
+                    sequence = sequences[key] = next(self.keySequence)
+                    if order is not None:
+                        order[0].append(key)
+                        order[1].append(sequence)
+        self.recordChange(parent, nodes)
+        parent.update(nodes)
+        for key, node in nodes.items():
+            self.indexNode(f"{parentPath}/{key}", node)
+        self.touchPath(parentPath)
+
+    def detachNode(self, path: str, parent: Optional[dict[str, Any]] = None, unindex: bool = True) -> Any:
+        # remove a node from the database and drop it and its children from the route index
+        # without unindex only the node's own route goes and the caller must unindex the rest later
+        parentPath, _, key = path.rpartition("/")
+        if parent is None:
+            parent = self.routes[parentPath] if parentPath else self.database
+        if key not in parent:
+            raise KeyError(key)
+        self.recordChange(parent, (key,))
+        node = parent.pop(key)
+        self.pendingDeletes.discard(path)
+        if parentPath in self.childOrders:
+            self.childOrders[parentPath] = None
+        if self.routes.get(path) is node:
+            if unindex:
+                self.unindexNode(path, node)
+            else:
+                self.routes.pop(path)
+                self.nodeVersions.pop(path, None)
+        self.touchPath(parentPath)
+        return node
+
+    def lookupNode(self, path: str) -> Any:
+        # the node at a path or Missing, a leaf is looked up in the node listing it as it has no route of its own
+        node = self.routes.get(path, Missing)
+        if node is Missing:
+            parentPath, _, key = path.rpartition("/")
+            parent = self.routes.get(parentPath)
+            if parent is not None and parent.get(key) is LeafNode:
+                return LeafNode
+        return node
+
+    def nodeVersion(self, path: str) -> int:
+        # a leaf has no version of its own so it takes the version of the node listing it
+        version = self.nodeVersions.get(path)
+        if version is None:
+            version = self.nodeVersions.get(path.rpartition("/")[0], 0)
+        return version
+
     def findDbEntity(self, path: list[str]) -> Any:
-        # search through the path until we find the correct object id in the database
-        layer = self.database
-        while len(path) > 0:
-            entity = path.pop(0)
-            layer = layer[entity]
-        return layer
-
-    def processGet(self, path: list[str]) -> dict[str, Any]:
+        # find the object in the route index, a missing path raises a KeyError
+        fullPath = "/".join(path)
+        node = self.lookupNode(fullPath)
+        if node is Missing:
+            raise KeyError(fullPath)
+        return node
+
+    @staticmethod
+    def encodeCursor(position: Any) -> str:
+        # cursors are opaque to clients, they hold the position of the last key returned
+        return urlsafe_b64encode(json.dumps([position]).encode()).decode()
+
+    @staticmethod
+    def decodeCursor(cursor: str) -> Any:
+        position, = json.loads(urlsafe_b64decode(cursor.encode()))
+        if isinstance(position, bool) or not isinstance(position, (int, str)):
+            raise ValueError(cursor)
+        return position
+
+    def childOrder(self, path: str, node: dict[str, Any]) -> tuple[list[str], list[Any]]:
+        # the keys of a node in the order they were added and the position of each, built from the node the first time
+        # it is read after a delete, a key keeps the sequence number it was first given so positions never move
+        if "?" in path:  # a query's matches are found again on every read so they are paged in key order, each key its own position
+            keys = sorted(node)
+            return keys, keys
+        order = self.childOrders.get(path)
+        while order is None or len(order[0]) != len(node):
+            sequences = self.childSequences.get(path) or {}
+            try:
+                keys = list(node)
+            except RuntimeError:  # a writer changed the node while it was listed so list it again
+                continue
+            for key in keys:
+                if key not in sequences:
+                    sequences[key] = next(self.keySequence)
+            if len(sequences) > len(keys):  # drop what was deleted
+                sequences = {key: sequences[key] for key in keys}
+            keys.sort(key=sequences.__getitem__)
+            order = (keys, [sequences[key] for key in keys])
+            if self.routes.get(path) is node:  # a node that is no longer in the tree is read from its own list
+                self.childSequences[path] = sequences
+                self.childOrders[path] = order
+        return order
+
+    def paginate(self, path: str, node: dict[str, Any], limit: int, cursor: Optional[str] = None) -> dict[str, Any]:
+        # return up to limit children of a node and the cursor to ask for the next page with
+        # the cursor holds the position of the last key returned so a page costs the same however deep into the node it is
+        keys, positions = self.childOrder(path, node)
+        offset = bisect_right(positions, self.decodeCursor(cursor)) if cursor else 0
+        page = {}
+        while offset < len(keys) and len(page) < limit:
+            key = keys[offset]
+            offset += 1
+            child = node.get(key, Missing)
+            if child is not Missing:  # deleted since the keys were listed
+                page[key] = child
+        nextCursor = None
+        if len(page) == limit and offset < len(keys):
+            nextCursor = self.encodeCursor(positions[offset - 1])
+        return {"items": page, "cursor": nextCursor}
+
+    def streamGet(self, path: str) -> Iterator[tuple[str, Any]]:
+        # yield the children of a node one at a time so listing a huge node runs in constant memory
+        node = self.findDbEntity(self.seperatePath(path))  # a missing path raises a KeyError straight away
+
+        def stream() -> Iterator[tuple[str, Any]]:
+            order = keys, positions = self.childOrder(path, node)
+            offset = 0
+            while True:
+                if self.childOrders.get(path, order) is not order:  # a delete means the keys are listed again
+                    lastPosition = positions[offset - 1] if offset else None
+                    order = keys, positions = self.childOrder(path, node)
+                    offset = bisect_right(positions, lastPosition) if lastPosition is not None else 0
+                if offset >= len(keys):
+                    return
+                key = keys[offset]
+                offset += 1
+                child = node.get(key, Missing)
+                if child is not Missing:
+                    yield key, child
+
+        return stream()
+
+    def processGet(self, path: list[str], data: Optional[dict[str, Any]] = None) -> dict[str, Any]:
         # search for the object id in the database and if it fails return a not found error
+        # a limit in the data asks for one page of children and stream asks for a generator of them
+        # snapshot asks for an immutable view, either of now or of an earlier snapshot passed in to read consistently
+        # ifNoneMatch is the version from an earlier response, if nothing has changed since only a 304 is returned
+        # a query after a ? such as customers?version>=3 returns only the children matching it
+        if "?" in path[-1]:
+            path[-1], _, query = path[-1].partition("?")
+            return self.processQuery(path, query, data)
+        if data and data.get("snapshot"):
+            snapshot = data["snapshot"] if isinstance(data["snapshot"], Snapshot) else self.snapshot()
+            return snapshot.get("/".join(path))
         try:
-            return self.generateResponse(200, self.findDbEntity(path))
+            node = self.findDbEntity(path)
         except KeyError:
             return self.generateResponse(404, {"message": "Not found"})
+        version = self.nodeVersion("/".join(path))
+        if data and data.get("ifNoneMatch") == version:
+            response = self.generateResponse(304, {"message": "Not modified"})
+        else:
+            response = self.readNode(path, node, data)
+        if response["statusCode"] in (200, 304):
+            response["version"] = version
+        return response
+
+    def processQuery(self, path: list[str], query: str, data: Optional[dict[str, Any]] = None) -> dict[str, Any]:
+        # look the query up in the indexes of the registry the path lists, a registry name on its own searches all of it
+        # the matching ids are returned with their names, under a node only its own children are kept
+        # the matches can be paged or streamed with the same data as a node's children
+        registryKey = path[-1]
+        node = self.routes.get("/".join(path))
+        if node is None and (len(path) > 1 or registryKey not in testObjects):
+            return self.generateResponse(404, {"message": "Not found"})
+        try:
+            ids = findIds(registryKey, query)
+        except (KeyError, ValueError):
+            return self.generateResponse(400, {"message": "Invalid query"})
+        registry = testObjects[registryKey]
+        matches = {}
+        for objectId in ids:
+            entity = registry.get(objectId)
+            if entity is not None and (node is None or objectId in node):
+                matches[objectId] = entity.name
+        if data and data.get("stream"):
+            return self.generateResponse(200, iter(matches.items()))
+        if data and "limit" in data:  # the matches are paged under the query's own path so no node's keys are reused
+            return self.readPage(f"{'/'.join(path)}?{query}", matches, data)
+        return self.generateResponse(200, matches)
+
+    def readNode(self, path: list[str], node: Any, data: Optional[dict[str, Any]]) -> dict[str, Any]:
+        if not data:
+            return self.generateResponse(200, node)
+        if data.get("stream"):
+            return self.generateResponse(200, self.streamGet("/".join(path)))
+        if "limit" in data:
+            return self.readPage("/".join(path), node, data)
+        return self.generateResponse(200, node)
+
+    def readPage(self, path: str, node: Any, data: dict[str, Any]) -> dict[str, Any]:
+        limit = data["limit"]
+        if not isinstance(limit, int) or limit < 1 or not isinstance(node, dict):
+            return self.generateResponse(400, {"message": "Bad request"})
+        try:
+            return self.generateResponse(200, self.paginate(path, node, limit, data.get("cursor")))
+        except (ValueError, TypeError):
+            return self.generateResponse(400, {"message": "Invalid cursor"})
 
     def processPost(self, path: list[str], data: dict[str, Any]) -> dict[str, Any]:
         # this method does not require a path but for simulation sake is has been left in
         # using the parent class we create a new child
+        # a count in the data creates that many children in one go, only users support this
         parent = data["from"]
-        id = parent.createChild(data["name"])
+        if "count" in data:
+            if not hasattr(parent, "createChildren"):
+                return self.generateResponse(400, {"message": "Bulk create not supported"})
+            try:
+                return self.generateResponse(200, parent.createChildren(data["count"], data.get("names")))
+            except ValueError as error:  # nothing has been made when the count and names are rejected
+                return self.generateResponse(400, {"message": str(error)})
+        try:
+            id = parent.createChild(data["name"])
+        except ValueError as error:  # a name that isn't a string is rejected before anything is made
+            return self.generateResponse(400, {"message": str(error)})
 
         return self.generateResponse(200, id)
 
     def processPut(self, path: list[str], data: dict[str, Any]) -> dict[str, Any]:
         # search for the object id in the database and if it fails return a not found error if it doesn't then update its name
         try:
-            self.findDbEntity(path.copy())  # does the object exist
+            node = self.findDbEntity(path)  # does the object exist
         except KeyError:
             return self.generateResponse(404, {"message": "Not found"})
 
+        fullPath = "/".join(path)
+        if node is LeafNode:  # a leaf's version is its parent's so that is the one to move on
+            fullPath = fullPath.rpartition("/")[0]
         objectId = path.pop()
         objectType = path.pop()
-        testObjects[objectType][objectId].name = data["name"]  # for sake of simplicity we're only updating names at the moment
+        try:
+            testObjects[objectType][objectId].name = data["name"]  # for sake of simplicity we're only updating names at the moment
+        except ValueError as error:
+            return self.generateResponse(400, {"message": str(error)})
+        self.version = next(self.versions)  # the tree itself is unchanged so there is no old value to keep for snapshots
+        self.touchPath(fullPath)
         return self.generateResponse(201, {"message": "updated"})
 
-    def processDelete(self, path: list[str]) -> dict[str, any]:
-        # search through to find the parent object to the target. Delete the target from the parent
-        entityId = path.copy().pop()  # we need the ID but will also be using the path later
-        layer = self.database
-        searchPath = path.copy()
-        while len(searchPath) > 1:
-            entity = searchPath.pop(0)
-            layer = layer[entity]
-        layer.pop(entityId)
+    def processDelete(self, path: list[str], data: Optional[dict[str, Any]] = None) -> dict[str, any]:
+        # delete the target and everything below it, if it fails return a not found error
+        # a background flag in the data hands back a handle straight away and finishes the delete on another thread
+        # the check and the delete happen under one lock so two deletes of the same path can't both go ahead
+        # the changes it publishes go onto the change feed after the lock is let go as the replicator may need it
+        with deferredPublishes(), self.lockFor(path):
+            return self.deleteEntity(path, data)
+
+    @staticmethod
+    def lockFor(path: list[str]) -> Any:
+        # the lock for the customer a path belongs to
+        # a whole channel takes no lock here, its delete takes each of its customers' locks and only holds the channel lock
+        # around its own detach, so a customer lock is never waited for while holding a channel lock
+        if "customers" in path[:-1]:
+            return locks.customer(path[path.index("customers") + 1])
+        if path[0] == "channels" and len(path) == 2:
+            return nullcontext()
+        if path[0] == "channels":
+            return locks.channel(path[1])
+        return locks.customer("")
+
+    def deleteEntity(self, path: list[str], data: Optional[dict[str, Any]]) -> dict[str, any]:
+        fullPath = "/".join(path)
+        # a path still waiting on the change feed to be detached is already gone as far as a second delete is concerned
+        if fullPath in self.pendingDeletes or self.lookupNode(fullPath) is Missing:
+            return self.generateResponse(404, {"message": "Not found"})
 
         # because we know the form of the path we can work out where the variables we need are
         objectId = path.pop()  # this will be the id of the object
         objectType = path.pop()  # this will be the type of object
-        testObjects[objectType].pop(objectId)
+        ownerId = ownerIndex.get(objectType, {}).get(objectId)
+        owner = testObjects[ownerRegistry[objectType]].get(ownerId) if ownerId is not None else None
+        entity = testObjects.get(objectType, {}).get(objectId)
+        if owner is None and not hasattr(entity, "delete"):  # nothing owns it or hangs off it so it only leaves this server
+            self.detachNode(fullPath)
+            entity = testObjects.get(objectType, {}).pop(objectId, None)
+            if entity is not None:
+                unindexObject(entity)
+            return self.generateResponse(200, {"message": "deleted"})
 
+        background = bool(data and data.get("background"))
+        # the owner removes it from every server, registry and index, a channel owned by nothing does so itself
+        self.pendingDeletes.add(fullPath)  # until detachNode takes it off this server
+        try:
+            handle = owner.deleteChild(objectId, background) if owner is not None else entity.delete(background)
+        except Exception:
+            self.pendingDeletes.discard(fullPath)
+            raise
+        if background:
+            return self.generateResponse(202, {"message": "deleting", "handle": handle})
         return self.generateResponse(200, {"message": "deleted"})
 
-    def sendCommand(self, request: str, path: str, data: Optional[dict[str, Any]] = None) -> dict[str, Any]:
+    def resolveOwner(self, tokenId: str) -> dict[str, Any]:
+        # follow the owner index from an access token up to its channel, if it fails return a not found error
+        try:
+            userId = ownerIndex["accessTokens"][tokenId]
+            customerId = ownerIndex["users"][userId]
+        except KeyError:
+            return self.generateResponse(404, {"message": "Not found"})
+        channelId = ownerIndex["customers"].get(customerId)
+        return self.generateResponse(200, {"user": userId, "customer": customerId, "channel": channelId})
 
-        # process commands sent to this object
-        processedPath = self.seperatePath(path)
+    def logWrite(self, request: str, path: str, data: Optional[dict[str, Any]], response: dict[str, Any]) -> None:
+        # record a successful write so it can be replayed after a restart
+        record = {"server": self.name, "request": request, "path": path}
+        if request == "post":
+            parent = data["from"]
+            record.update({"from": [parent.registryKey, parent.id], "result": response["data"]})
+            if "count" in data:
+                record.update({"count": data["count"], "names": data.get("names")})
+            else:
+                record["name"] = data["name"]
+        elif request in ("put", "channel"):
+            record["name"] = data["name"]
+        elif request == "versions":
+            record["versions"] = data["versions"]
+        pending = getattr(self.batchLog, "records", None)
+        if pending is not None:
+            pending.append(record)
+        else:
+            self.writeAheadLog.append(record)
 
-        if request.lower() == "get":
-            return self.processGet(processedPath)
-        elif request.lower() == "post":
-            return self.processPost(processedPath, data)
-        elif request.lower() == "put":
-            return self.processPut(processedPath, data)
-        elif request.lower() == "delete":
-            return self.processDelete(processedPath)
+    def processCommand(self, request: str, path: list[str], data: Optional[dict[str, Any]] = None) -> dict[str, Any]:
+        # process a request and if there is a write ahead log attached record it when it succeeds
+        if self.writeAheadLog is None or request == "get":
+            return self.routeCommand(request, path, data)
+        fullPath = "/".join(path)  # the handlers use up the path list so keep a copy for the log
+        response = self.routeCommand(request, path, data)
+        if response["statusCode"] < 300:
+            self.logWrite(request, fullPath, data, response)
+        return response
 
-        # Route all paths and if we can't return a 405 error
+    def routeCommand(self, request: str, path: list[str], data: Optional[dict[str, Any]] = None) -> dict[str, Any]:
+        # route an already lowercased request to its handler and if we can't return a 405 error
+        if request == "get":
+            return self.processGet(path, data)
+        elif request == "post":
+            return self.processPost(path, data)
+        elif request == "put":
+            return self.processPut(path, data)
+        elif request == "delete":
+            return self.processDelete(path, data)
 
         return self.generateResponse(405, {"message": "Request not allowed"})
+
+    def sendCommand(self, request: str, path: str, data: Optional[dict[str, Any]] = None) -> dict[str, Any]:
+
+        # process commands sent to this object, timing them when metrics are switched on
+        request = request.lower()
+        metrics = self.metrics
+        if metrics is None:
+            return self.processCommand(request, self.seperatePath(path), data)
+        if path == metricsPath and request == "get":
+            return self.generateResponse(200, metrics.snapshot())
+
+        # the route and its counters are cached per request type and path so a repeated request builds nothing
+        # a query is left out of the route so every query shares it
+        cache = metrics.routeCache.get(request)
+        entry = cache.get(path) if cache is not None else None
+        if entry is None:
+            entry = metrics.cacheRoute(request, path, self.routeTemplate(self.seperatePath(path.partition("?")[0])))
+        started = perf_counter_ns()
+        response = self.processCommand(request, self.seperatePath(path), data)
+        elapsed = perf_counter_ns() - started
+        buckets = entry[1].get(response["statusCode"])
+        if buckets is None:
+            buckets = metrics.statusBuckets(entry[1], response["statusCode"])
+        buckets[bisect_left(latencyBuckets, elapsed)] += 1
+        return response
+
+    def validateBatch(self, operations: list[tuple[str, str, Optional[dict[str, Any]]]]) -> dict[int, dict[str, Any]]:
+        # work out which operations of a batch would fail without changing anything
+        failures = {}
+        deleted = set()  # paths removed by earlier operations in the batch
+        deletedIds = set()  # and the ids of the objects at those paths
+        for index, (request, path, data) in enumerate(operations):
+            request = request.lower()
+            if request not in ("get", "post", "put", "delete"):
+                failures[index] = self.generateResponse(405, {"message": "Request not allowed"})
+                continue
+            if request == "post":
+                if not data or "from" not in data or ("name" not in data and "count" not in data):
+                    failures[index] = self.generateResponse(400, {"message": "Bad request"})
+                elif not self.isRegistered(data["from"]) or self.hasDeletedOwner(data["from"], deletedIds):
+                    failures[index] = self.generateResponse(400, {"message": "Bad request"})
+                continue
+
+            segments = self.seperatePath(path)
+            prefixes = ("/".join(segments[:end]) for end in range(1, len(segments) + 1))
+            if self.lookupNode(path) is Missing or any(prefix in deleted for prefix in prefixes):
+                failures[index] = self.generateResponse(404, {"message": "Not found"})
+            elif request == "put" and (not data or "name" not in data or len(segments) < 2
+                                       or segments[-1] not in testObjects.get(segments[-2], {})):
+                failures[index] = self.generateResponse(400, {"message": "Bad request"})
+            elif request == "delete":
+                deleted.add(path)
+                deletedIds.add(segments[-1])
+        return failures
+
+    @staticmethod
+    def isRegistered(entity: Any) -> bool:
+        registryKey = getattr(entity, "registryKey", None)
+        return registryKey in testObjects and testObjects[registryKey].get(getattr(entity, "id", None)) is entity
+
+    @staticmethod
+    def hasDeletedOwner(entity: Any, deletedIds: set[str]) -> bool:
+        # follow the owner index up from an object to see if it or anything above it is deleted earlier in the batch
+        registryKey, objectId = entity.registryKey, entity.id
+        while objectId is not None:
+            if objectId in deletedIds:
+                return True
+            objectId = ownerIndex.get(registryKey, {}).get(objectId)
+            registryKey = ownerRegistry.get(registryKey)
+        return False
+
+    def sendBatch(self, operations: list[tuple[str, str, Optional[dict[str, Any]]]], atomic: bool = False) -> list[dict[str, Any]]:
+        # process a list of (request, path, data) operations and return a response for each in the same order
+        # runs of plain gets are answered straight from the route index with each parent's route worked out once
+        # and runs of posts from one parent that can mint in bulk are made with a single createChildren call
+        # with atomic set nothing is applied unless every operation in the batch succeeds, anything applied is undone
+        if atomic:
+            failures = self.validateBatch(operations)
+            if failures:
+                skipped = self.generateResponse(424, {"message": "Batch not applied"})
+                return [failures.get(index, skipped) for index in range(len(operations))]
+            self.batchLog.records = []  # the write ahead log only sees the batch once all of it has been applied
+        undo: Optional[list[tuple[Any, ...]]] = [] if atomic else None
+        verbs = [request.lower() for request, _, _ in operations]
+        responses: list[Optional[dict[str, Any]]] = [None] * len(operations)
+        index = 0
+        try:
+            while index < len(operations):
+                end = index + 1
+                _, path, data = operations[index]
+                if verbs[index] == "get" and not data:
+                    while end < len(operations) and verbs[end] == "get" and not operations[end][2]:
+                        end += 1
+                    self.batchGets(operations, index, end, responses)
+                elif verbs[index] == "post" and self.bulkPost(data):
+                    parent = data["from"]
+                    while (end < len(operations) and verbs[end] == "post" and operations[end][1] == path
+                           and self.bulkPost(operations[end][2]) and operations[end][2]["from"] is parent):
+                        end += 1
+                    self.batchPosts(operations, index, end, responses, undo)
+                else:
+                    responses[index] = self.batchCommand(verbs[index], path, data, undo)
+                if undo is not None:
+                    failed = next((position for position in range(index, end) if responses[position]["statusCode"] >= 300), None)
+                    if failed is not None:
+                        self.rollback(undo)
+                        skipped = self.generateResponse(424, {"message": "Batch not applied"})
+                        return [responses[failed] if position == failed else skipped for position in range(len(operations))]
+                index = end
+        finally:
+            records = getattr(self.batchLog, "records", None)
+            self.batchLog.records = None
+        if records and self.writeAheadLog is not None:
+            for record in records:
+                self.writeAheadLog.append(record)
+        return responses
+
+    @staticmethod
+    def bulkPost(data: Optional[dict[str, Any]]) -> bool:
+        # a post that only names one new child of a parent able to make many at once
+        return bool(data) and data.keys() == {"from", "name"} and hasattr(data["from"], "createChildren")
+
+    def batchGets(self, operations: list[tuple[str, str, Optional[dict[str, Any]]]], start: int, end: int,
+                  responses: list[Optional[dict[str, Any]]]) -> None:
+        # reads are tallied by path while they run and each parent's route template is only worked out once at the end
+        found: dict[str, int] = {}
+        notFound: dict[str, int] = {}
+        started = perf_counter_ns()
+        for index in range(start, end):
+            path = operations[index][1]
+            node = self.lookupNode(path)
+            if node is not Missing:
+                responses[index] = {"statusCode": 200, "data": node, "version": self.nodeVersion(path)}
+                found[path] = found.get(path, 0) + 1
+            elif "?" in path or path == metricsPath:
+                responses[index] = self.sendCommand("get", path)  # queries and metrics are timed by sendCommand
+            else:
+                responses[index] = self.generateResponse(404, {"message": "Not found"})
+                notFound[path] = notFound.get(path, 0) + 1
+        if self.metrics is None:
+            return
+        elapsed = (perf_counter_ns() - started) // (end - start)
+        templates: dict[str, str] = {}  # children of one parent share a route template
+        tallies: dict[tuple[str, int], int] = {}
+        for statusCode, counts in ((200, found), (404, notFound)):
+            for path, count in counts.items():
+                parentPath = path.rpartition("/")[0] or path
+                route = templates.get(parentPath)
+                if route is None:
+                    route = templates[parentPath] = self.routeTemplate(self.seperatePath(path))
+                tallies[route, statusCode] = tallies.get((route, statusCode), 0) + count
+        for (route, statusCode), count in tallies.items():
+            self.metrics.recordMany("get", route, statusCode, elapsed, count)
+
+    def batchPosts(self, operations: list[tuple[str, str, Optional[dict[str, Any]]]], start: int, end: int,
+                   responses: list[Optional[dict[str, Any]]], undo: Optional[list[tuple[Any, ...]]]) -> None:
+        path = operations[start][1]
+        parent = operations[start][2]["from"]
+        names = [operations[index][2]["name"] for index in range(start, end)]
+        started = perf_counter_ns()
+        try:
+            response = self.processCommand("post", self.seperatePath(path), {"from": parent, "count": len(names), "names": names})
+        except (AttributeError, KeyError, TypeError, ValueError):
+            response = self.generateResponse(400, {"message": "Bad request"})
+        if self.metrics is not None:
+            self.metrics.recordMany("post", self.routeTemplate(self.seperatePath(path)), response["statusCode"],
+                                    (perf_counter_ns() - started) // len(names), len(names))
+        if response["statusCode"] >= 300:
+            for index in range(start, end):
+                responses[index] = response
+            return
+        for index, childId in zip(range(start, end), response["data"]):
+            responses[index] = self.generateResponse(200, childId)
+        if undo is not None:
+            undo.append(("post", parent, response["data"]))
+
+    def batchCommand(self, request: str, path: str, data: Optional[dict[str, Any]], undo: Optional[list[tuple[Any, ...]]]) -> dict[str, Any]:
+        # any other operation goes through sendCommand, in an atomic batch after noting how to undo it
+        entry = None
+        if undo is not None and request in ("put", "delete"):
+            segments = self.seperatePath(path)
+            entity = testObjects.get(segments[-2], {}).get(segments[-1]) if len(segments) > 1 else None
+            if request == "put" and entity is not None:
+                entry = ("put", segments, entity.name)
+            elif request == "delete" and self.lookupNode(path) is not Missing:
+                records = captureSubtree(segments[-2], segments[-1]) if entity is not None else []
+                entry = ("delete", path, self.lookupNode(path), records)
+                data = {**data, "background": False} if data else data  # the subtree must be gone before carrying on
+        try:
+            response = self.sendCommand(request, path, data)
+        except (AttributeError, KeyError, TypeError, ValueError):  # data missing what the request needs
+            return self.generateResponse(400, {"message": "Bad request"})
+        if entry is not None and response["statusCode"] < 300:
+            undo.append(entry)
+        elif undo is not None and request == "post" and response["statusCode"] < 300:
+            childIds = response["data"] if isinstance(response["data"], tuple) else (response["data"],)
+            undo.append(("post", data["from"], childIds))
+        return response
+
+    def rollback(self, undo: list[tuple[Any, ...]]) -> None:
+        # undo the operations of a failed atomic batch, newest first
+        for entry in reversed(undo):
+            if entry[0] == "post":
+                _, parent, childIds = entry
+                for childId in childIds:
+                    parent.deleteChild(childId).wait()
+            elif entry[0] == "put":
+                _, segments, name = entry
+                self.processPut(list(segments), {"name": name})
+            elif entry[3]:
+                restoreSubtree(entry[3])
+            else:
+                _, path, node, _ = entry
+                self.attachNode(path, node)
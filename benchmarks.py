@@ -0,0 +1,356 @@
+import argparse
+import json
+import random
+import socket
+import threading
+import time
+import tracemalloc
+from typing import Any, Callable, Optional
+from uuid import uuid4
+from databaseObjects import testObjects
+from objects import Channel, MainServer, ManagementServer, Schema
+from columns import numpy
+from httpServer import HttpFrontEnd
+from serialization import ResponseEncoder, encodeResponse
+
+defaultMix = {"get": 0.7, "post": 0.1, "put": 0.1, "delete": 0.1}
+
+
+def measureBytes(build: Callable[[], Any]) -> int:
+    # measure how much memory is still held by whatever the build function returns
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    kept = build()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del kept
+    return after - before
+
+
+def benchmarkEntityMemory(count: int = 100000) -> dict[str, float]:
+    # the bytes each access token costs once made through createChild, counting the registry, owner index,
+    # query indexes, database tree and route index together
+    channel = Channel(f"memory-{uuid4()}", "Memory Channel")
+    customer = testObjects["customers"][channel.createChild("Memory Customer")]
+    user = testObjects["users"][customer.createChild("Memory User")]
+    routes = len(MainServer.routes)
+    used = measureBytes(lambda: [user.createChild("Token") for _ in range(count)] and None)
+    return {"tokens": count, "bytesPerToken": used / count, "routesPerToken": (len(MainServer.routes) - routes) / count}
+
+
+def buildHierarchy(channels: int, customers: int, users: int, tokens: int, prefix: str = "bench") -> dict[str, list[Any]]:
+    # build a synthetic hierarchy through the real createChild chain, the counts are per parent
+    hierarchy = {"channels": [], "customers": [], "users": [], "tokens": []}
+    for channelNumber in range(channels):
+        channel = Channel(f"{prefix}-channel{channelNumber}", f"Channel {channelNumber}")
+        hierarchy["channels"].append(channel)
+        for customerNumber in range(customers):
+            customer = testObjects["customers"][channel.createChild(f"Customer {customerNumber}")]
+            hierarchy["customers"].append(customer)
+            for userNumber in range(users):
+                user = testObjects["users"][customer.createChild(f"User {userNumber}")]
+                hierarchy["users"].append(user)
+                for tokenNumber in range(tokens):
+                    hierarchy["tokens"].append((user, user.createChild(f"Token {tokenNumber}")))
+    return hierarchy
+
+
+def percentile(ordered: list[int], fraction: float) -> float:
+    # nearest rank percentile of an already sorted list of nanosecond timings, returned in microseconds
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] / 1000
+
+
+def randomOperation(hierarchy: dict[str, list[Any]], verb: str, randomiser: random.Random) -> tuple[Any, str, str, Optional[dict[str, Any]]]:
+    # pick a server, path and data for one operation, half of the reads and writes go to each server
+    onMain = randomiser.random() < 0.5
+    if verb == "delete" and hierarchy["tokens"]:
+        user, tokenId = hierarchy["tokens"].pop(randomiser.randrange(len(hierarchy["tokens"])))
+        return MainServer, "delete", f"{user.getPath()}/accessTokens/{tokenId}", None
+    if verb == "post":
+        if onMain and hierarchy["users"]:
+            return MainServer, "post", "accessTokens", {"name": "Load Token", "from": randomiser.choice(hierarchy["users"])}
+        return ManagementServer, "post", "customers", {"name": "Load Customer", "from": randomiser.choice(hierarchy["channels"])}
+    if onMain and hierarchy["tokens"]:
+        user, tokenId = randomiser.choice(hierarchy["tokens"])
+        path = f"{user.getPath()}/accessTokens/{tokenId}"
+        return MainServer, verb, path, {"name": "Renamed Token"} if verb == "put" else None
+    channel = randomiser.choice(hierarchy["channels"])
+    return ManagementServer, "put" if verb == "put" else "get", f"channels/{channel.id}", {"name": "Renamed Channel"} if verb == "put" else None
+
+
+def runWorkload(hierarchy: dict[str, list[Any]], operations: int, mix: Optional[dict[str, float]] = None, seed: int = 0) -> dict[str, Any]:
+    # send a mixed workload through both servers and report throughput and latency percentiles per verb
+    mix = mix or defaultMix
+    randomiser = random.Random(seed)
+    verbs = randomiser.choices(list(mix), weights=list(mix.values()), k=operations)
+    timings: dict[str, list[int]] = {verb: [] for verb in mix}
+    started = time.perf_counter()
+    for verb in verbs:
+        server, request, path, data = randomOperation(hierarchy, verb, randomiser)
+        before = time.perf_counter_ns()
+        response = server.sendCommand(request, path, data)
+        timings[request].append(time.perf_counter_ns() - before)
+        if request == "post" and response["statusCode"] == 200 and data["from"].registryKey == "users":
+            hierarchy["tokens"].append((data["from"], response["data"]))
+    elapsed = time.perf_counter() - started
+
+    results = {"operations": operations, "seconds": elapsed, "throughput": operations / elapsed, "verbs": {}}
+    for verb, verbTimings in timings.items():
+        verbTimings.sort()
+        busy = sum(verbTimings) / 1e9
+        results["verbs"][verb] = {
+            "count": len(verbTimings),
+            "throughput": len(verbTimings) / busy if busy else 0.0,
+            "p50": percentile(verbTimings, 0.50),
+            "p95": percentile(verbTimings, 0.95),
+            "p99": percentile(verbTimings, 0.99),
+        }
+    return results
+
+
+def benchmarkValidation(hierarchy: dict[str, list[Any]], operations: int = 100000, sampleRate: int = 1) -> dict[str, float]:
+    # time gets on token, user and customer routes with and without checking each response's shape
+    schema = Schema(sampleRate)
+    schema.getSchema()  # compile the validators up front as a loaded schema would be
+    paths = []
+    for user, tokenId in hierarchy["tokens"][:1000]:
+        paths.extend((f"{user.getPath()}/accessTokens/{tokenId}", user.getPath(), f"customers/{user.customerId}/users"))
+    paths = [paths[number % len(paths)] for number in range(operations)]
+
+    started = time.perf_counter()
+    for path in paths:
+        MainServer.sendCommand("get", path)
+    plain = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for path in paths:
+        schema.checkValueAgainstSchema(MainServer.sendCommand("get", path), "get", path)
+    validated = time.perf_counter() - started
+    return {"operations": operations, "sampleRate": sampleRate, "plainSeconds": plain, "validatedSeconds": validated,
+            "overheadPercent": (validated - plain) / plain * 100}
+
+
+def benchmarkSerialization(hierarchy: dict[str, list[Any]], operations: int = 100000) -> dict[str, float]:
+    # time repeated gets of every channel's customer list encoded from scratch and through the cache
+    paths = [f"channels/{channel.id}/customers" for channel in hierarchy["channels"]]
+    paths = [paths[number % len(paths)] for number in range(operations)]
+    encoder = ResponseEncoder(ManagementServer)
+
+    started = time.perf_counter()
+    for path in paths:
+        encodeResponse(ManagementServer.sendCommand("get", path))
+    plain = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for path in paths:
+        encoder.sendCommand("get", path)
+    cached = time.perf_counter() - started
+    return {"operations": operations, "plainSeconds": plain, "cachedSeconds": cached, "speedup": plain / cached,
+            "hits": encoder.hits, "misses": encoder.misses}
+
+
+def latencySummary(timings: list[int], seconds: float) -> dict[str, float]:
+    timings.sort()
+    return {"requestsPerSecond": len(timings) / seconds, "p50": percentile(timings, 0.50),
+            "p99": percentile(timings, 0.99), "p999": percentile(timings, 0.999)}
+
+
+def readHttpResponse(reader: Any) -> int:
+    # read one response off a keep alive connection and return its status code
+    status = int(reader.readline().split()[1])
+    length = 0
+    for line in iter(reader.readline, b"\r\n"):
+        name, _, value = line.partition(b":")
+        if name.lower() == b"content-length":
+            length = int(value)
+    reader.read(length)
+    return status
+
+
+def pipelinedGets(address: tuple[str, int], paths: list[str], depth: int, timings: list[int]) -> None:
+    # send the gets over one connection depth at a time without waiting for answers in between
+    # each request is timed from when its group was sent to when its own response has been read
+    with socket.create_connection(address) as connection:
+        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        reader = connection.makefile("rb")
+        for start in range(0, len(paths), depth):
+            group = paths[start:start + depth]
+            sent = time.perf_counter_ns()
+            connection.sendall(b"".join(f"GET /{path} HTTP/1.1\r\nHost: benchmark\r\n\r\n".encode() for path in group))
+            for _ in group:
+                readHttpResponse(reader)
+                timings.append(time.perf_counter_ns() - sent)
+
+
+def benchmarkHttp(hierarchy: dict[str, list[Any]], operations: int = 20000, connections: int = 4,
+                  pipelineDepth: int = 8, workers: int = 8) -> dict[str, Any]:
+    # gets of users and tokens sent in process through the encoder and then over loopback http to the same server
+    paths = []
+    for user, tokenId in hierarchy["tokens"][:1000]:
+        paths.extend((f"{user.getPath()}/accessTokens/{tokenId}", user.getPath()))
+    paths = [paths[number % len(paths)] for number in range(operations)]
+
+    encoder = ResponseEncoder(MainServer)
+    timings: list[int] = []
+    started = time.perf_counter()
+    for path in paths:
+        before = time.perf_counter_ns()
+        encoder.sendCommand("get", path)
+        timings.append(time.perf_counter_ns() - before)
+    inProcess = latencySummary(timings, time.perf_counter() - started)
+
+    frontEnd = HttpFrontEnd(MainServer, workers=workers)
+    address = frontEnd.start()
+    timings = []
+    clients = [threading.Thread(target=pipelinedGets, args=(address, paths[number::connections], pipelineDepth, timings))
+               for number in range(connections)]
+    started = time.perf_counter()
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    overHttp = latencySummary(timings, time.perf_counter() - started)
+    frontEnd.close()
+    return {"operations": operations, "connections": connections, "pipelineDepth": pipelineDepth, "workers": workers,
+            "inProcess": inProcess, "http": overHttp}
+
+
+def benchmarkRollout(customers: int = 100000) -> dict[str, Any]:
+    # upgrade and count every customer of one channel a customer at a time and then through the version column
+    channel = Channel(f"rollout-{uuid4()}", "Rollout Channel")
+    customerIds = [channel.createChild(f"Rollout Customer {number}") for number in range(customers)]
+
+    started = time.perf_counter()
+    for customerId in customerIds:
+        channel.updateCustomerVersion(customerId)
+    counts: dict[int, int] = {}
+    for customerId in customerIds:
+        version = testObjects["customers"][customerId].version
+        counts[version] = counts.get(version, 0) + 1
+    perCustomer = time.perf_counter() - started
+
+    started = time.perf_counter()
+    channel.updateCustomerVersions()
+    histogram = channel.getVersionHistogram()
+    vectorized = time.perf_counter() - started
+    return {"customers": customers, "numpy": numpy is not None, "perCustomerSeconds": perCustomer,
+            "columnSeconds": vectorized, "speedup": perCustomer / vectorized, "histogram": histogram}
+
+
+def benchmarkBatch(hierarchy: dict[str, list[Any]], operations: int = 100000) -> dict[str, Any]:
+    # time the same gets of tokens and posts of new tokens sent one sendCommand at a time and as batches
+    paths = [f"{user.getPath()}/accessTokens/{tokenId}" for user, tokenId in hierarchy["tokens"]]
+    gets = [("get", paths[number % len(paths)], None) for number in range(operations)]
+    users = hierarchy["users"]
+    posts = [("post", "accessTokens", {"name": f"Batch Token {number}", "from": users[number * len(users) // operations]})
+             for number in range(operations)]
+    results = {"operations": operations}
+    for name, batch in (("get", gets), ("post", posts)):
+        half = len(batch) // 2
+        started = time.perf_counter()
+        for request, path, data in batch[:half]:
+            MainServer.sendCommand(request, path, data)
+        single = (time.perf_counter() - started) / half
+        started = time.perf_counter()
+        MainServer.sendBatch(batch[half:])
+        batched = (time.perf_counter() - started) / (len(batch) - half)
+        results[name] = {"sendCommandMicroseconds": single * 1e6, "sendBatchMicroseconds": batched * 1e6, "speedup": single / batched}
+    return results
+
+
+def benchmarkSharding(hierarchy: dict[str, list[Any]], shardCounts: list[int], operations: int = 200000, batchSize: int = 2000) -> dict[str, Any]:
+    # compare token get throughput in this process against routers with different numbers of shard workers
+    from sharding import ShardRouter  # only needed here and it starts worker processes
+
+    tokens = hierarchy["tokens"]
+    paths = [f"{user.getPath()}/accessTokens/{tokenId}" for user, tokenId in tokens]
+    batches = []
+    for start in range(0, operations, batchSize):
+        batches.append([("get", paths[(start + number) % len(paths)], None) for number in range(min(batchSize, operations - start))])
+
+    def measure(sendBatch: Callable[[list[tuple[str, str, None]]], Any]) -> float:
+        started = time.perf_counter()
+        for batch in batches:
+            sendBatch(batch)
+        return operations / (time.perf_counter() - started)
+
+    results = {"operations": operations, "inProcess": measure(MainServer.sendBatch), "shards": {}}
+    for shardCount in shardCounts:
+        router = ShardRouter(shardCount)
+        try:
+            throughput = measure(router.sendBatch)
+        finally:
+            router.close()
+        results["shards"][shardCount] = {"throughput": throughput, "speedup": throughput / results["inProcess"]}
+    return results
+
+
+def saveResults(results: dict[str, Any], path: str) -> None:
+    with open(path, "w") as file:
+        json.dump(results, file, indent=2)
+
+
+def compareResults(baseline: dict[str, Any], current: dict[str, Any], tolerance: float = 0.1) -> list[str]:
+    # list every verb whose p50, p95 or p99 latency got worse than the baseline by more than the tolerance
+    regressions = []
+    for verb, baselineVerb in baseline["verbs"].items():
+        currentVerb = current["verbs"].get(verb)
+        if currentVerb is None:
+            continue
+        for measure in ("p50", "p95", "p99"):
+            if baselineVerb[measure] and currentVerb[measure] > baselineVerb[measure] * (1 + tolerance):
+                regressions.append(f"{verb} {measure}: {baselineVerb[measure]:.2f}us -> {currentVerb[measure]:.2f}us")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark sendCommand against a synthetic hierarchy")
+    parser.add_argument("--channels", type=int, default=10)
+    parser.add_argument("--customers", type=int, default=10, help="customers per channel")
+    parser.add_argument("--users", type=int, default=5, help="users per customer")
+    parser.add_argument("--tokens", type=int, default=5, help="access tokens per user")
+    parser.add_argument("--operations", type=int, default=100000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="save the results as json to this file")
+    parser.add_argument("--baseline", help="compare against results saved by an earlier run")
+    parser.add_argument("--memory", action="store_true", help="report bytes per access token instead")
+    parser.add_argument("--shards", type=int, nargs="+", metavar="COUNT", help="report sharded read throughput instead")
+    parser.add_argument("--validation", type=int, metavar="SAMPLE_RATE", help="report response validation overhead instead")
+    parser.add_argument("--serialization", action="store_true", help="report cached response encoding speed instead")
+    parser.add_argument("--batch", action="store_true", help="report sendBatch cost per operation against sendCommand instead")
+    parser.add_argument("--rollout", type=int, metavar="CUSTOMERS", help="report bulk version rollout speed for one channel instead")
+    parser.add_argument("--http", type=int, nargs=3, metavar=("CONNECTIONS", "PIPELINE_DEPTH", "WORKERS"),
+                        help="report loopback http throughput and tail latency against in process gets instead")
+    arguments = parser.parse_args()
+
+    if arguments.memory:
+        print(json.dumps(benchmarkEntityMemory(), indent=2))
+    elif arguments.shards:
+        builtHierarchy = buildHierarchy(arguments.channels, arguments.customers, arguments.users, arguments.tokens)
+        print(json.dumps(benchmarkSharding(builtHierarchy, arguments.shards, arguments.operations), indent=2))
+    elif arguments.validation:
+        builtHierarchy = buildHierarchy(arguments.channels, arguments.customers, arguments.users, arguments.tokens)
+        print(json.dumps(benchmarkValidation(builtHierarchy, arguments.operations, arguments.validation), indent=2))
+    elif arguments.http:
+        builtHierarchy = buildHierarchy(arguments.channels, arguments.customers, arguments.users, arguments.tokens)
+        print(json.dumps(benchmarkHttp(builtHierarchy, arguments.operations, *arguments.http), indent=2))
+    elif arguments.rollout:
+        print(json.dumps(benchmarkRollout(arguments.rollout), indent=2))
+    elif arguments.batch:
+        builtHierarchy = buildHierarchy(arguments.channels, arguments.customers, arguments.users, arguments.tokens)
+        print(json.dumps(benchmarkBatch(builtHierarchy, arguments.operations), indent=2))
+    elif arguments.serialization:
+        builtHierarchy = buildHierarchy(arguments.channels, arguments.customers, arguments.users, arguments.tokens)
+        print(json.dumps(benchmarkSerialization(builtHierarchy, arguments.operations), indent=2))
+    else:
+        builtHierarchy = buildHierarchy(arguments.channels, arguments.customers, arguments.users, arguments.tokens)
+        workloadResults = runWorkload(builtHierarchy, arguments.operations, seed=arguments.seed)
+        print(json.dumps(workloadResults, indent=2))
+        if arguments.output:
+            saveResults(workloadResults, arguments.output)
+        if arguments.baseline:
+            with open(arguments.baseline) as baselineFile:
+                for regression in compareResults(json.load(baselineFile), workloadResults):
+                    print(f"Regression: {regression}")
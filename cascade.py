@@ -0,0 +1,113 @@
+import threading
+from typing import Callable, Iterable, Optional
+from databaseObjects import testObjects, ownerIndex, ownerRegistry
+from indexes import unindexObject
+
+childRegistry = {"channels": ("customers", "customers"), "customers": ("users", "users"), "users": ("accessTokens", "accessTokens")}
+# for each registry the attribute its objects keep their child ids in and the registry those children live in
+
+
+class DeleteHandle:  # lets the caller follow a cascading delete that may still be running in the background
+
+    def __init__(self):
+        self.total = 0  # how many objects the subtree holds, known once it has been collected
+        self.removed = 0
+        self.error: Optional[BaseException] = None
+        self.finished = threading.Event()
+
+    def progress(self) -> float:
+        if self.finished.is_set():
+            return 1.0
+        return self.removed / self.total if self.total else 0.0
+
+    def done(self) -> bool:
+        return self.finished.is_set()
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        return self.finished.wait(timeout)
+
+
+def collectSubtree(registryKey: str, objectId: str) -> dict[str, list[str]]:
+    # gather the ids of an object and everything below it one level at a time, grouped by registry
+    subtree = {registryKey: [objectId]}
+    level = [objectId]
+    while registryKey in childRegistry and level:
+        attribute, childKey = childRegistry[registryKey]
+        registry = testObjects[registryKey]
+        children = []
+        for parentId in level:
+            parent = registry.get(parentId)
+            if parent is not None:
+                children.extend(getattr(parent, attribute))
+        subtree[childKey] = children
+        registryKey, level = childKey, children
+    return subtree
+
+
+def captureSubtree(registryKey: str, objectId: str) -> list[tuple[str, type, str, str, Optional[str], Optional[int]]]:
+    # record what is needed to make an object and everything below it again, parents come before their children
+    records = []
+    for key, ids in collectSubtree(registryKey, objectId).items():
+        registry = testObjects[key]
+        owners = ownerIndex.get(key, {})
+        for childId in ids:
+            entity = registry.get(childId)
+            if entity is not None:
+                records.append((key, type(entity), childId, entity.name, owners.get(childId), getattr(entity, "version", None)))
+    return records
+
+
+def restoreSubtree(records: list[tuple[str, type, str, str, Optional[str], Optional[int]]]) -> None:
+    # make captured objects again under their old ids through their owners so every server and index gets them back
+    for key, entityClass, objectId, name, ownerId, version in records:
+        if objectId in testObjects[key]:  # only what is gone is made again
+            continue
+        if key not in ownerRegistry:
+            entityClass(objectId, name)
+        elif ownerId is not None:
+            testObjects[ownerRegistry[key]][ownerId].createChild(name, objectId)
+        if version is not None:
+            testObjects[key][objectId].version = version
+
+
+def purgeSubtree(subtree: dict[str, list[str]], handle: DeleteHandle, chunkSize: int) -> None:
+    # one pass over each registry and index dropping every id in the subtree
+    for registryKey, ids in subtree.items():
+        registry = testObjects[registryKey]
+        owners = ownerIndex.get(registryKey, {})
+        for start in range(0, len(ids), chunkSize):
+            for objectId in ids[start:start + chunkSize]:
+                entity = registry.pop(objectId, None)
+                if entity is not None:
+                    unindexObject(entity)
+                owners.pop(objectId, None)
+            handle.removed += len(ids[start:start + chunkSize])
+
+
+def cascadeDelete(registryKey: str, objectId: str, cleanups: Iterable[Callable[[], None]] = (),
+                  background: bool = False, chunkSize: int = 10000, handle: Optional[DeleteHandle] = None) -> DeleteHandle:
+    # remove an object and its whole subtree from the registries, the object must already be detached from the servers
+    # cleanups run first and are for work that can wait, such as dropping a large subtree from a route index
+    # in the background the work happens on its own thread and the handle reports progress and completion
+    if handle is None:
+        handle = DeleteHandle()
+
+    def run() -> None:
+        try:
+            subtree = collectSubtree(registryKey, objectId)
+            handle.total = sum(len(ids) for ids in subtree.values())
+            for cleanup in cleanups:
+                cleanup()
+            purgeSubtree(subtree, handle, chunkSize)
+        except BaseException as error:
+            handle.error = error
+            if not background:
+                raise
+        finally:
+            handle.finished.set()
+
+    if background:
+        threading.Thread(target=run, name=f"cascade-delete-{objectId}", daemon=True).start()
+    else:
+        run()
+    return handle
@@ -0,0 +1,111 @@
+import threading
+from collections import deque
+from contextlib import contextmanager
+from time import perf_counter
+from typing import Any, Callable, Iterator, Optional
+
+held = threading.local()  # the changes each thread is holding back until it has let go of its locks
+
+
+@contextmanager
+def deferredPublishes() -> Iterator[None]:
+    # changes published on this thread inside the block go onto their feeds once it ends
+    # so a writer holding a lock the replicator needs never waits for room on a full feed while holding it
+    if getattr(held, "changes", None) is not None:  # already held back further out
+        yield
+        return
+    held.changes = []
+    try:
+        yield
+    finally:
+        changes, held.changes = held.changes, None
+        for feed, kind, arguments in changes:
+            feed.publish(kind, *arguments)
+
+
+class ChangeFeed:  # ordered log of changes waiting to be applied to a replica server
+
+    def __init__(self, apply: Callable[[str, tuple[Any, ...]], None], batchSize: int = 256, maxPending: int = 100000):
+        self.apply = apply  # called with the kind and arguments of each change in the order they were published
+        self.batchSize = batchSize  # how many changes the replicator takes off the feed at a time
+        self.maxPending = maxPending  # publishers wait once this many changes are unapplied so the lag stays bounded
+        self.events: deque[tuple[int, float, str, tuple[Any, ...]]] = deque()
+        self.published = 0  # sequence number of the last change published
+        self.applied = 0  # sequence number of the last change applied
+        self.lastError: Optional[BaseException] = None
+        self.condition = threading.Condition()
+        self.worker: Optional[threading.Thread] = None
+        self.running = False
+
+    def publish(self, kind: str, *arguments: Any) -> int:
+        # until replication is started a change is applied straight away in the caller's thread
+        # inside deferredPublishes it is only queued on the thread and 0 is returned as it has no sequence number yet
+        if getattr(held, "changes", None) is not None:
+            held.changes.append((self, kind, arguments))
+            return 0
+        if self.worker is None:
+            with self.condition:  # only the numbering is locked so writers to different customers still overlap
+                self.published += 1
+                sequence = self.published
+            self.apply(kind, arguments)
+            self.applied = max(self.applied, sequence)
+            return sequence
+        with self.condition:
+            while self.published - self.applied >= self.maxPending:
+                self.condition.wait()
+            self.published += 1
+            self.events.append((self.published, perf_counter(), kind, arguments))
+            self.condition.notify_all()
+            return self.published
+
+    def start(self) -> None:
+        # apply changes on a replicator thread from now on
+        if self.worker is not None:
+            return
+        self.running = True
+        self.worker = threading.Thread(target=self.replicate, name="change-feed", daemon=True)
+        self.worker.start()
+
+    def stop(self) -> None:
+        # apply everything already published then go back to applying changes straight away
+        if self.worker is None:
+            return
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        self.worker.join()
+        self.worker = None
+
+    def replicate(self) -> None:
+        while True:
+            with self.condition:
+                while not self.events and self.running:
+                    self.condition.wait()
+                if not self.events:
+                    return
+                batch = [self.events.popleft() for _ in range(min(self.batchSize, len(self.events)))]
+            for sequence, _, kind, arguments in batch:
+                try:
+                    self.apply(kind, arguments)
+                except Exception as error:  # one bad change must not stop the replica, keep it to be looked at
+                    self.lastError = error
+            with self.condition:
+                self.applied = batch[-1][0]
+                self.condition.notify_all()
+
+    def lag(self) -> dict[str, Any]:
+        # how far the replica is behind in changes and in seconds since the oldest unapplied change was published
+        with self.condition:
+            oldest = self.events[0][1] if self.events else None
+            return {
+                "published": self.published,
+                "applied": self.applied,
+                "pending": self.published - self.applied,
+                "seconds": perf_counter() - oldest if oldest is not None else 0.0,
+            }
+
+    def waitFor(self, sequence: Optional[int] = None, timeout: Optional[float] = None) -> bool:
+        # wait until the given change, or everything published so far, has been applied
+        with self.condition:
+            target = self.published if sequence is None else sequence
+            return self.condition.wait_for(lambda: self.applied >= target, timeout)
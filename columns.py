@@ -0,0 +1,173 @@
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import Counter
+from typing import Any, Iterator, Optional
+
+try:
+    import numpy
+except ImportError:  # without numpy the columns are plain arrays and bulk operations loop over them in python
+    numpy = None
+
+noChannel = -1  # channel code of a customer that is not listed by any channel
+freeRow = -2  # channel code of a row whose customer has gone, it is handed to the next customer made
+cohortMultiplier = 2654435761  # spreads row numbers evenly over 0-99 so a percentage cohort is a fixed slice of rows
+
+
+class VersionColumn:  # every customer's version in one array so a whole channel can be rolled out in one operation
+
+    def __init__(self, capacity: int = 1024):
+        self.versions = self.allocateColumn(capacity)
+        self.channels = self.allocateColumn(capacity)  # the code of the channel listing each row's customer
+        self.ids: list[Optional[str]] = []  # the id of the customer in each row
+        self.channelCount = 0
+        self.freeRows: list[int] = []
+        self.size = 0  # rows handed out so far, the columns may have spare capacity past this
+        self.order: Optional[Any] = None  # rows in version order for range queries, dropped whenever a version changes
+        self.lock = threading.RLock()  # growing the columns replaces them so writes wait for it to finish
+        # reentrant as a customer freed by the garbage collector gives its row back from whatever thread it was on
+        self.valueType = int  # lets the column answer queries in place of a SecondaryIndex
+
+    @staticmethod
+    def allocateColumn(capacity: int) -> Any:
+        if numpy is not None:
+            return numpy.zeros(capacity, dtype=numpy.int64)
+        return array("q", bytes(8 * capacity))
+
+    def grow(self) -> None:
+        capacity = len(self.versions) * 2
+        if numpy is not None:
+            self.versions = numpy.resize(self.versions, capacity)
+            self.channels = numpy.resize(self.channels, capacity)
+        else:
+            self.versions.extend(bytes(8 * len(self.versions)))
+            self.channels.extend(bytes(8 * len(self.channels)))
+
+    def allocate(self, customerId: str, version: int) -> int:
+        # give a new customer a row holding its version, reusing the row of a customer that has gone if there is one
+        with self.lock:
+            if self.freeRows:
+                row = self.freeRows.pop()
+                self.ids[row] = customerId
+            else:
+                row = self.size
+                if row == len(self.versions):
+                    self.grow()
+                self.size += 1
+                self.ids.append(customerId)
+            self.versions[row] = version
+            self.channels[row] = noChannel
+            self.order = None
+            return row
+
+    def free(self, row: int) -> None:
+        with self.lock:
+            self.channels[row] = freeRow
+            self.ids[row] = None
+            self.freeRows.append(row)
+            self.order = None
+
+    def getVersion(self, row: int) -> int:
+        return int(self.versions[row])
+
+    def setVersion(self, row: int, version: int) -> None:
+        with self.lock:
+            self.versions[row] = version
+            self.order = None
+
+    def channelCode(self) -> int:
+        # each channel object gets its own code so a channel made again under the same id starts with no customers
+        with self.lock:
+            self.channelCount += 1
+            return self.channelCount - 1
+
+    def assignChannel(self, row: int, code: int) -> None:
+        with self.lock:  # a grow running at the same time would copy the old column and lose the code
+            self.channels[row] = code
+
+    def cohort(self, code: Optional[int] = None, fromVersion: Optional[int] = None, percentage: float = 100) -> Any:
+        # the rows of a channel's customers, or every customer's, narrowed to one version and a percentage of rows
+        # the same rows are always in a percentage so growing a rollout from 10 to 50 percent keeps the first 10
+        if numpy is None:
+            return [row for row in range(self.size)
+                    if (self.channels[row] == code if code is not None else self.channels[row] != freeRow)
+                    and (fromVersion is None or self.versions[row] == fromVersion)
+                    and row * cohortMultiplier % 100 < percentage]
+        channels = self.channels[:self.size]
+        mask = channels == code if code is not None else channels != freeRow
+        if fromVersion is not None:
+            mask &= self.versions[:self.size] == fromVersion
+        if percentage < 100:
+            mask &= numpy.arange(self.size, dtype=numpy.uint64) * numpy.uint64(cohortMultiplier) % numpy.uint64(100) < percentage
+        return numpy.flatnonzero(mask)
+
+    def rollout(self, step: int, code: Optional[int] = None, fromVersion: Optional[int] = None, percentage: float = 100) -> int:
+        # move every version in a cohort by step at once and return how many customers were moved
+        return len(self.rolloutRows(step, code, fromVersion, percentage))
+
+    def rolloutRows(self, step: int, code: Optional[int] = None, fromVersion: Optional[int] = None, percentage: float = 100) -> Any:
+        # as rollout but return the rows that were moved
+        with self.lock:
+            rows = self.cohort(code, fromVersion, percentage)
+            if numpy is not None:
+                self.versions[rows] += step
+            else:
+                for row in rows:
+                    self.versions[row] += step
+            self.order = None
+            return rows
+
+    def histogram(self, code: Optional[int] = None) -> dict[int, int]:
+        # how many customers of a channel, or of every channel, are on each version
+        rows = self.cohort(code)
+        if numpy is None:
+            return dict(sorted(Counter(self.versions[row] for row in rows).items()))
+        versions, counts = numpy.unique(self.versions[rows], return_counts=True)
+        return {int(version): int(count) for version, count in zip(versions, counts)}
+
+    def sortedRows(self) -> tuple[Any, Any]:
+        # every live row sorted by version along with the sorted versions, sorted again only after a version changed
+        order = self.order
+        if order is None:
+            rows = self.cohort()
+            if numpy is not None:
+                rows = rows[numpy.argsort(self.versions[rows], kind="stable")]
+                order = self.order = (rows, self.versions[rows])
+            else:
+                rows.sort(key=self.versions.__getitem__)
+                order = self.order = (rows, [self.versions[row] for row in rows])
+        return order
+
+    def add(self, value: int, objectId: str) -> None:
+        pass  # the column is written by the customers themselves so there is nothing more to index
+
+    def addMany(self, pairs: Any) -> None:
+        pass
+
+    def remove(self, value: int, objectId: str) -> None:
+        pass
+
+    def find(self, operator: str, value: int) -> Iterator[str]:
+        # the ids of the customers on versions matching a filter, a binary search over the sorted rows finds them
+        rows, versions = self.sortedRows()
+        if numpy is not None:
+            search = lambda side: int(numpy.searchsorted(versions, value, side))
+        else:
+            search = lambda side: (bisect_left if side == "left" else bisect_right)(versions, value)
+        if operator in ("=", "=="):
+            start, end = search("left"), search("right")
+        elif operator == ">=":
+            start, end = search("left"), len(rows)
+        elif operator == ">":
+            start, end = search("right"), len(rows)
+        elif operator == "<=":
+            start, end = 0, search("right")
+        elif operator == "<":
+            start, end = 0, search("left")
+        else:
+            raise ValueError(f"Invalid operator {operator} for versions")
+        ids = self.ids
+        return (ids[row] for row in rows[start:end] if ids[row] is not None)
+
+
+versionColumn = VersionColumn()
@@ -1,2 +1,8 @@
 testObjects = {"channels": {}, "customers": {}, "users": {}, "accessTokens": {}}
-# used to organise objects during tests
\ No newline at end of file
+# used to organise objects during tests
+ownerIndex = {"customers": {}, "users": {}, "accessTokens": {}}
+# maps the id of an object to the id of the object that owns it so owners can be found without a search
+ownerRegistry = {"customers": "channels", "users": "customers", "accessTokens": "users"}
+# the registry the owner of each type of object is kept in
+LeafNode: dict = {}  # access tokens never have children so every token in the database shares this node
+# the servers don't index leaves by path, a leaf is found through the node listing it
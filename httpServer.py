@@ -0,0 +1,124 @@
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from typing import Any, Optional
+from urllib.parse import unquote, urlsplit
+from databaseObjects import testObjects
+from serialization import ResponseEncoder
+
+badRequest = b'{"statusCode":400,"data":{"message":"Bad request"}}'
+notFound = b'{"statusCode":404,"data":{"message":"Not found"}}'
+commandParameters = {"limit", "cursor", "stream", "background"}  # query parameters passed to the command as data
+booleanValues = {"true": True, "1": True, "false": False, "0": False}  # how stream and background may be spelled
+
+
+class ApiRequestHandler(BaseHTTPRequestHandler):  # maps one connection's http requests onto the api server's commands
+    protocol_version = "HTTP/1.1"  # connections are kept open and pipelined requests are answered in the order they came
+    disable_nagle_algorithm = True  # headers and body are written separately so don't let the body wait on an ack
+
+    def setup(self) -> None:
+        self.timeout = self.server.idleTimeout  # an idle keep alive connection gives its worker back after this long
+        super().setup()
+
+    def handleCommand(self) -> None:
+        url = urlsplit(self.path)
+        path = url.path.strip("/")
+        try:
+            data, filters = self.readData(url.query)
+        except ValueError:
+            self.sendBytes(400, badRequest)
+            return
+        if filters:
+            path = f"{path}?{'&'.join(filters)}"
+        if self.command == "POST":
+            # the parent comes from the path so posting to customers/<id>/users creates a user for that customer
+            segments = path.split("/")
+            parent = testObjects.get(segments[-3], {}).get(segments[-2]) if len(segments) >= 3 else None
+            if parent is None:
+                self.sendBytes(404, notFound)
+                return
+            data["from"] = parent
+        try:
+            response, encoded = self.server.encoder.send(self.command, path, data or None)
+        except (KeyError, TypeError):  # a post or put without the fields it needs
+            self.sendBytes(400, badRequest)
+            return
+        version = response.get("version")
+        if response["statusCode"] == 304:
+            encoded = b""  # a not modified response never has a body
+        self.sendBytes(response["statusCode"], encoded, version)
+
+    do_GET = do_POST = do_PUT = do_DELETE = handleCommand
+
+    def readData(self, query: str) -> tuple[dict[str, Any], list[str]]:
+        # the data for a command is the json body with its query parameters and an If-None-Match version added to it
+        # the rest of the query string is filters such as version>=3 which are passed on in the path
+        length = int(self.headers.get("Content-Length", 0))
+        data = json.loads(self.rfile.read(length)) if length else {}
+        if not isinstance(data, dict):
+            raise ValueError("the body must be a json object")
+        filters = []
+        for part in filter(None, query.split("&")):
+            key, _, value = unquote(part).partition("=")
+            if key in ("stream", "background"):
+                if value.lower() not in booleanValues:
+                    raise ValueError(f"{key} must be true or false")
+                data[key] = booleanValues[value.lower()]
+            elif key in commandParameters:
+                data[key] = int(value) if value.isdigit() else value
+            else:
+                filters.append(unquote(part))
+        etag = self.headers.get("If-None-Match")
+        if etag:
+            data["ifNoneMatch"] = int(etag.strip('"'))
+        return data, filters
+
+    def sendBytes(self, code: int, body: bytes, version: Optional[int] = None) -> None:
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        if version is not None:
+            self.send_header("ETag", f'"{version}"')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass  # the api server's metrics already count every request
+
+
+class HttpFrontEnd(HTTPServer):  # serves one api server over http/1.1 from a fixed pool of worker threads
+
+    def __init__(self, server: Any, address: tuple[str, int] = ("127.0.0.1", 0), workers: int = 8,
+                 idleTimeout: float = 5.0, cacheBytes: int = 64 * 1024 * 1024):
+        # each open connection is served by one worker until it closes or sits idle, further connections wait their turn
+        super().__init__(address, ApiRequestHandler)
+        self.api = server
+        self.encoder = ResponseEncoder(server, cacheBytes)
+        self.idleTimeout = idleTimeout
+        self.pool = ThreadPoolExecutor(workers, thread_name_prefix="http-worker")
+        self.thread: Optional[threading.Thread] = None
+
+    def process_request(self, request: Any, clientAddress: Any) -> None:
+        self.pool.submit(self.serveConnection, request, clientAddress)
+
+    def serveConnection(self, request: Any, clientAddress: Any) -> None:
+        try:
+            self.finish_request(request, clientAddress)
+        except Exception:
+            self.handle_error(request, clientAddress)
+        finally:
+            self.shutdown_request(request)
+
+    def start(self) -> tuple[str, int]:
+        # accept connections on a background thread and return the address being listened on
+        self.thread = threading.Thread(target=self.serve_forever, name="http-acceptor", daemon=True)
+        self.thread.start()
+        return self.server_address
+
+    def close(self) -> None:
+        if self.thread is not None:
+            self.shutdown()
+            self.thread.join()
+        self.server_close()
+        self.pool.shutdown(wait=False, cancel_futures=True)
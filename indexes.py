@@ -0,0 +1,128 @@
+import re
+from bisect import bisect_left, bisect_right, insort
+from typing import Any, Iterable, Iterator, Optional
+from columns import versionColumn
+
+filterPattern = re.compile(r"^(\w+)(\^=|>=|<=|==|=|>|<)(.*)$")  # attribute, operator and value of one query filter
+
+
+class SecondaryIndex:  # the ids of one registry's objects grouped by the value of one of their attributes
+
+    def __init__(self, valueType: type = str):
+        self.valueType = valueType  # query values are converted to this before they are looked up
+        self.ids: dict[Any, Any] = {}  # a value held by one object maps to its id, by more than one to a set of ids
+        self.values: list[Any] = []  # every value in sorted order for range and prefix lookups, kept sorted as it changes
+
+    def addId(self, value: Any, objectId: str) -> bool:
+        # returns True when no object held the value before so it still has to go in values
+        ids = self.ids.get(value)
+        if ids is None:
+            self.ids[value] = objectId
+            return True
+        if isinstance(ids, set):
+            ids.add(objectId)
+        elif ids != objectId:
+            self.ids[value] = {ids, objectId}
+        return False
+
+    def add(self, value: Any, objectId: str) -> None:
+        if self.addId(value, objectId):
+            insort(self.values, value)
+
+    def addMany(self, pairs: Iterable[tuple[Any, str]]) -> None:
+        # new values are merged in with one sort, which finds the two sorted runs, rather than an insort each
+        newValues = [value for value, objectId in pairs if self.addId(value, objectId)]
+        if len(newValues) > 1:
+            newValues.sort()
+            self.values.extend(newValues)
+            self.values.sort()
+        elif newValues:
+            insort(self.values, newValues[0])
+
+    def remove(self, value: Any, objectId: str) -> None:
+        ids = self.ids.get(value)
+        if isinstance(ids, set):
+            ids.discard(objectId)
+            if len(ids) == 1:
+                self.ids[value] = next(iter(ids))
+        elif ids == objectId:
+            del self.ids[value]
+            position = bisect_left(self.values, value)
+            if position < len(self.values) and self.values[position] == value:
+                del self.values[position]
+
+    def sortedValues(self) -> list[Any]:
+        return self.values
+
+    def idsFor(self, values: Iterable[Any]) -> Iterator[str]:
+        for value in values:
+            ids = self.ids.get(value)
+            if isinstance(ids, set):
+                yield from list(ids)
+            elif ids is not None:
+                yield ids
+
+    def find(self, operator: str, value: Any) -> Iterator[str]:
+        # the ids matching one filter, a binary search finds where the matching values start
+        if operator in ("=", "=="):
+            return self.idsFor((value,))
+        values = self.sortedValues()
+        if operator == "^=":
+            start = bisect_left(values, value)
+            end = start
+            while end < len(values) and values[end].startswith(value):
+                end += 1
+            return self.idsFor(values[start:end])
+        if operator == ">=":
+            return self.idsFor(values[bisect_left(values, value):])
+        if operator == ">":
+            return self.idsFor(values[bisect_right(values, value):])
+        if operator == "<=":
+            return self.idsFor(values[:bisect_right(values, value)])
+        return self.idsFor(values[:bisect_left(values, value)])
+
+
+queryIndexes = {
+    "channels": {"name": SecondaryIndex()},
+    "customers": {"name": SecondaryIndex(), "version": versionColumn},  # versions are searched in the column itself
+    "users": {"name": SecondaryIndex()},
+    "accessTokens": {"name": SecondaryIndex()},
+}
+# the attributes each registry can be queried by, kept up to date as objects are registered, changed and removed
+
+
+def indexObject(entity: Any) -> None:
+    for attribute, index in queryIndexes[entity.registryKey].items():
+        index.add(getattr(entity, attribute), entity.id)
+
+
+def unindexObject(entity: Any) -> None:
+    for attribute, index in queryIndexes[entity.registryKey].items():
+        index.remove(getattr(entity, attribute), entity.id)
+
+
+def reindexAttribute(entity: Any, attribute: str, oldValue: Any, newValue: Any) -> None:
+    index = queryIndexes[entity.registryKey].get(attribute)
+    if index is not None:
+        index.remove(oldValue, entity.id)
+        index.add(newValue, entity.id)
+
+
+def findIds(registryKey: str, query: str) -> list[str]:
+    # the ids of a registry's objects matching every filter in a query such as version>=3&name^=ab
+    # an unknown registry or attribute raises a KeyError and a malformed filter or value a ValueError
+    indexes = queryIndexes[registryKey]
+    matches: Optional[list[str]] = None
+    for text in query.split("&"):
+        found = filterPattern.match(text)
+        if found is None:
+            raise ValueError(f"Invalid filter {text}")
+        attribute, operator, value = found.groups()
+        index = indexes[attribute]
+        ids = index.find(operator, index.valueType(value))
+        if matches is None:
+            matches = list(ids)
+        else:
+            wanted = set(ids)
+            matches = [objectId for objectId in matches if objectId in wanted]
+    return matches
@@ -0,0 +1,34 @@
+import threading
+import zlib
+from contextlib import nullcontext
+from typing import ContextManager
+
+
+class LockManager:  # striped locks so a writer only waits for writers to the same customer or channel
+
+    def __init__(self, stripes: int = 64):
+        self.enabled = False  # until concurrency is switched on every lock is a no-op
+        self.customerLocks = [threading.RLock() for _ in range(stripes)]
+        self.channelLocks = [threading.RLock() for _ in range(stripes)]
+
+    def enable(self) -> None:
+        self.enabled = True
+
+    def disable(self) -> None:
+        self.enabled = False
+
+    def customer(self, customerId: str) -> ContextManager:
+        # held for any change to a customer's subtree, a channel lock may be taken inside it but never the other way round
+        if not self.enabled:
+            return nullcontext()
+        return self.customerLocks[zlib.crc32(customerId.encode()) % len(self.customerLocks)]
+
+    def channel(self, channelId: str) -> ContextManager:
+        # held for changes to a channel's node on the management server, nothing else is locked while holding it
+        if not self.enabled:
+            return nullcontext()
+        return self.channelLocks[zlib.crc32(channelId.encode()) % len(self.channelLocks)]
+
+
+locks = LockManager()
+# readers never take these locks, a get is a single lookup in the route index
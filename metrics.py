@@ -0,0 +1,75 @@
+from bisect import bisect_left
+from typing import Any
+
+latencyBuckets = (1000, 2000, 5000, 10000, 20000, 50000, 100000, 1000000, 10000000)
+# upper bounds of the latency histogram buckets in nanoseconds, anything slower goes in one last overflow bucket
+routeCacheSize = 16384  # paths whose route is remembered per request type, the cache starts again once it is full
+
+
+class RequestMetrics:  # counters for the requests a server handles, cheap enough to leave switched on
+
+    def __init__(self):
+        # per request type and route the counters of each status code, one per latency bucket
+        # the totals are only worked out when a snapshot is asked for
+        self.counts: dict[tuple[str, str], dict[int, list[int]]] = {}
+        self.routeCache: dict[str, dict[str, tuple[str, dict[int, list[int]]]]] = {}
+        # per request type the route and counters of recently seen paths, so a request finds them with two dict lookups
+
+    def routeCounters(self, request: str, route: str) -> dict[int, list[int]]:
+        return self.counts.setdefault((request, route), {})
+
+    def cacheRoute(self, request: str, path: str, route: str) -> tuple[str, dict[int, list[int]]]:
+        cache = self.routeCache.setdefault(request, {})
+        if len(cache) >= routeCacheSize:
+            cache.clear()
+        entry = cache[path] = (route, self.routeCounters(request, route))
+        return entry
+
+    @staticmethod
+    def statusBuckets(counters: dict[int, list[int]], statusCode: int) -> list[int]:
+        return counters.setdefault(statusCode, [0] * (len(latencyBuckets) + 1))
+
+    @staticmethod
+    def add(counters: dict[int, list[int]], statusCode: int, elapsed: int, count: int = 1) -> None:
+        # nothing is locked so under threads the counts are close rather than exact
+        buckets = counters.get(statusCode)
+        if buckets is None:
+            buckets = RequestMetrics.statusBuckets(counters, statusCode)
+        buckets[bisect_left(latencyBuckets, elapsed)] += count
+
+    def record(self, request: str, route: str, statusCode: int, elapsed: int) -> None:
+        self.add(self.routeCounters(request, route), statusCode, elapsed)
+
+    def recordMany(self, request: str, route: str, statusCode: int, elapsed: int, count: int) -> None:
+        # count requests handled together as a batch, elapsed is the time each one took on average
+        self.add(self.routeCounters(request, route), statusCode, elapsed, count)
+
+    def snapshot(self) -> dict[str, Any]:
+        # total the counters up by request type, route and status code along with the 404 rates
+        verbs: dict[str, int] = {}
+        routes: dict[str, int] = {}
+        routeNotFound: dict[str, int] = {}
+        statusCodes: dict[int, int] = {}
+        histograms: dict[str, list[int]] = {}
+        for (request, route), counters in list(self.counts.items()):
+            for statusCode, buckets in list(counters.items()):
+                count = sum(buckets)
+                verbs[request] = verbs.get(request, 0) + count
+                routes[route] = routes.get(route, 0) + count
+                statusCodes[statusCode] = statusCodes.get(statusCode, 0) + count
+                if statusCode == 404:
+                    routeNotFound[route] = routeNotFound.get(route, 0) + count
+                histogram = histograms.setdefault(request, [0] * (len(latencyBuckets) + 1))
+                for bucket, bucketCount in enumerate(buckets):
+                    histogram[bucket] += bucketCount
+        total = sum(verbs.values())
+        return {
+            "requests": total,
+            "verbs": verbs,
+            "routes": routes,
+            "statusCodes": statusCodes,
+            "notFoundRate": statusCodes.get(404, 0) / total if total else 0.0,
+            "routeNotFoundRates": {route: count / routes[route] for route, count in routeNotFound.items()},
+            "latencyBuckets": list(latencyBuckets),
+            "latencyHistograms": histograms,
+        }
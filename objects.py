@@ -1,46 +1,260 @@
-from typing import Optional, Any
+import os
+from collections.abc import Iterator, Mapping
+from typing import Optional, Any, Callable
 from uuid import uuid4
 from apiServer import ApiServer
-from databaseObjects import testObjects
+from cascade import DeleteHandle, cascadeDelete
+from changeFeed import ChangeFeed
+from columns import noChannel, versionColumn
+from databaseObjects import LeafNode, testObjects, ownerIndex
+from indexes import indexObject, queryIndexes, reindexAttribute, unindexObject
+from locking import locks
+from snapshots import Missing
 
 
-ManagementServer = ApiServer({"channels": {}})
+ManagementServer = ApiServer({"channels": {}}, "management")
 
-MainServer = ApiServer({"customers": {}})
+MainServer = ApiServer({"customers": {}}, "main")
+
+versionNibble = bytes((byte & 0x0F) | 0x40 for byte in range(256))  # translation tables that set the uuid4 version
+variantBits = bytes((byte & 0x3F) | 0x80 for byte in range(256))  # and variant bits on every byte at once
+
+
+def generateIds(count: int) -> list[str]:
+    # make count uuid4 strings from one block of random bytes instead of one uuid4() call each
+    raw = bytearray(os.urandom(16 * count))
+    raw[6::16] = raw[6::16].translate(versionNibble)
+    raw[8::16] = raw[8::16].translate(variantBits)
+    digits = raw.hex()
+    return [f"{digits[start:start + 8]}-{digits[start + 8:start + 12]}-{digits[start + 12:start + 16]}-"
+            f"{digits[start + 16:start + 20]}-{digits[start + 20:start + 32]}" for start in range(0, 32 * count, 32)]
+
+
+def checkName(name: Any) -> None:
+    # names are kept sorted in the query index so anything but a string can't be compared with the rest
+    if not isinstance(name, str):
+        raise ValueError(f"Invalid name {name!r}")
+
+
+def logVersions(rows: Any) -> None:
+    # versions aren't changed through a command so the version each moved customer ended up on is logged here
+    # read and logged under the column's lock so the last record for a customer always holds its latest version
+    if MainServer.writeAheadLog is None:
+        return
+    with versionColumn.lock:
+        versions = {versionColumn.ids[row]: versionColumn.getVersion(row) for row in rows}
+        versions.pop(None, None)  # a row freed since it was moved
+        if versions:
+            MainServer.logWrite("versions", "customers", {"versions": versions}, {})
+
+
+def deleteFromMain(registryKey: str, objectId: str, path: str, parent: Optional[dict[str, Any]], background: bool, handle: DeleteHandle) -> None:
+    # detach an object from the main server and cascade the delete through everything below it
+    # in the background only the route index and registries are left to clean up once it is detached
+    # a delete of its whole channel may have detached it already, what is left of it is still cascaded
+    if MainServer.lookupNode(path) is Missing:
+        node = None
+    else:
+        node = MainServer.detachNode(path, parent, unindex=not background)
+    cleanups = [lambda: MainServer.unindexNode(path, node)] if background and node is not None else []
+    cascadeDelete(registryKey, objectId, cleanups, background, handle=handle)
+
+
+def deleteChannelFromMain(channelId: str, customerIds: list[str], background: bool, handle: DeleteHandle) -> None:
+    # detach a deleted channel's customers from the main server and cascade the delete through the whole channel
+    detached = []
+    for customerId in customerIds:
+        path = f"customers/{customerId}"
+        with locks.customer(customerId):
+            if path in MainServer.routes:
+                detached.append((path, MainServer.detachNode(path, unindex=not background)))
+    cleanups = [lambda: [MainServer.unindexNode(path, node) for path, node in detached]] if background else []
+    cascadeDelete("channels", channelId, cleanups, background, handle=handle)
+
+
+def applyMainChange(kind: str, arguments: tuple[Any, ...]) -> None:
+    # every change the objects make to the main server comes through here from the change feed
+    # and is made while holding the lock for the customer whose subtree it changes
+    if kind == "deleteChannel":  # takes the lock of each of the channel's customers in turn
+        deleteChannelFromMain(*arguments)
+        return
+    if kind in ("rename", "versions"):  # the main server's tree holds no names or versions, a shard router forwards them
+        return
+    path = arguments[2] if kind == "delete" else arguments[0]
+    with locks.customer(path.split("/")[1]):
+        if kind == "attach":
+            MainServer.attachNode(*arguments)
+        elif kind == "attachMany":
+            MainServer.attachNodes(*arguments)
+        elif kind == "delete":
+            deleteFromMain(*arguments)
+
+
+MainFeed = ChangeFeed(applyMainChange)
+# the main server is a replica of these changes, call MainFeed.start() to apply them on a replicator thread
 
 
 class DefaultObjects:  # Every object will have a similar layout to this default class
+    __slots__ = ("id", "_name")  # slots keep each object small when there are millions of them
+    registryKey = ""  # the testObjects registry this type of object is kept in
 
     def __init__(self, id: str, name: str, ):
         self.id = id
-        self.name = name
+        self._name = name
+
+    @property
+    def name(self) -> str:
+        return self._name
+
+    @name.setter
+    def name(self, name: str) -> None:
+        # a registered object is moved to its new name in the query index
+        checkName(name)
+        if testObjects.get(self.registryKey, {}).get(self.id) is self:
+            reindexAttribute(self, "name", self._name, name)
+            self._name = name
+            MainFeed.publish("rename", self.registryKey, self.id)
+        else:
+            self._name = name
 
-    def createChild(self, name: str) -> str: # each object will override create child to make their own child object
+    def register(self) -> None:
+        # add the object to its registry and the query indexes, replacing any object already kept under its id
+        # a name that can't be indexed raises a ValueError before anything has changed
+        checkName(self._name)
+        previous = testObjects[self.registryKey].get(self.id)
+        if previous is not None:
+            unindexObject(previous)
+        testObjects[self.registryKey][self.id] = self
+        indexObject(self)
+
+    def createChild(self, name: str, childId: Optional[str] = None) -> str: # each object will override create child to make their own child object
+        pass  # a child id is only passed in when restoring saved objects
+
+    def deleteChild(self, childId: str, background: bool = False) -> DeleteHandle: # each object with children will override this to delete one
         pass
 
+def responseShape(data: Any) -> dict[str, Any]:
+    return {"statusCode": int, "data": data}
+
+
+def pageShape(data: Any) -> dict[str, Any]:
+    # a page holds some of a node's children so only a node whose every child has the same shape is checked further
+    items = data if isinstance(data, dict) and "*" in data else dict
+    return responseShape({"items": items, "cursor": (str, type(None))})
+
+
+childNodes = {"*": dict}  # a node whose values are all child nodes
+
+responseSchemas = {  # the shape of a successful response for each request and route template
+    ("get", "customers"): responseShape({"*": {"users": dict}}),
+    ("get", "customers/{id}"): responseShape({"users": childNodes}),
+    ("get", "customers/{id}/users"): responseShape({"*": {"accessTokens?": childNodes}}),
+    ("get", "customers/{id}/users/{id}"): responseShape({"accessTokens?": childNodes}),
+    ("get", "customers/{id}/users/{id}/accessTokens"): responseShape(childNodes),
+    ("get", "customers/{id}/users/{id}/accessTokens/{id}"): responseShape(dict),
+    ("get", "channels"): responseShape({"*": {"customers": childNodes}}),
+    ("get", "channels/{id}"): responseShape({"customers": childNodes}),
+    ("get", "channels/{id}/customers"): responseShape(childNodes),
+    ("get", "channels/{id}/customers/{id}"): responseShape(dict),
+    ("post", "customers"): responseShape(str),
+    ("post", "users"): responseShape(str),
+    ("post", "accessTokens"): responseShape((str, tuple)),  # a bulk create returns every new id
+    ("put", "*"): responseShape({"message": str}),
+    ("delete", "*"): responseShape({"message": str, "handle?": object}),
+}
+errorSchema = responseShape({"message": str})
+streamSchema = responseShape(Iterator)  # streamed children are only checked once they are read, not up front
+querySchema = responseShape({"*": str})  # the ids matching a query with their names
+
+
+def compileSchema(schema: Any) -> Callable[[Any], bool]:
+    # turn a schema into a function that checks a value against it so the schema is only interpreted once
+    # a schema is a type, or a dict of keys to schemas where a key ending in ? is optional and * matches every key
+    if isinstance(schema, (type, tuple)):  # a tuple of types accepts any of them
+        return lambda value: isinstance(value, schema)
+    if "*" in schema:
+        checkChild = compileSchema(schema["*"])
+        return lambda value: isinstance(value, Mapping) and all(checkChild(child) for child in value.values())
+    required = [(key, compileSchema(child)) for key, child in schema.items() if not key.endswith("?")]
+    optional = [(key[:-1], compileSchema(child)) for key, child in schema.items() if key.endswith("?")]
+
+    def check(value: Any) -> bool:
+        if not isinstance(value, Mapping):
+            return False
+        for key, checkChild in required:
+            if key not in value or not checkChild(value[key]):
+                return False
+        for key, checkChild in optional:
+            if key in value and not checkChild(value[key]):
+                return False
+        return True
+
+    return check
+
+
 class Schema:  # this is a singleton that mimics the schema we would have in the real system
 
-    def __init__(self):
+    def __init__(self, sampleRate: int = 1):
         self.schema = ""
+        self.validators: dict[tuple[str, str], Callable[[Any], bool]] = {}  # compiled once per route template when the schema loads
+        self.pageValidators: dict[tuple[str, str], Callable[[Any], bool]] = {}  # for gets asking for a page of children
+        self.errorValidator: Optional[Callable[[Any], bool]] = None
+        self.streamValidator: Optional[Callable[[Any], bool]] = None
+        self.queryValidator: Optional[Callable[[Any], bool]] = None
+        self.sampleRate = sampleRate  # only one in this many responses for a route is checked against its shape
+        self.responses: dict[tuple[str, str], int] = {}  # responses seen for each request and route template
 
     def getSchema(self): # create a "schema"
         if not self.schema:
             self.schema = "Active"
+            self.validators = {route: compileSchema(schema) for route, schema in responseSchemas.items()}
+            self.pageValidators = {route: compileSchema(pageShape(schema["data"])) for route, schema in responseSchemas.items() if route[0] == "get"}
+            self.errorValidator = compileSchema(errorSchema)
+            self.streamValidator = compileSchema(streamSchema)
+            self.queryValidator = compileSchema(querySchema)
             return self.schema
         else:
             return self.schema
 
-    def checkValueAgainstSchema(self, value: Any) -> None:
+    def checkValueAgainstSchema(self, value: Any, request: Optional[str] = None, path: Optional[str] = None,
+                                data: Optional[dict[str, Any]] = None) -> None:
         # this is only used for test purposes
+        # given the request and path the shape of the response is checked too, and the data it was sent with
+        # tells a page or a stream of children apart from a whole node
         schema = self.getSchema()
         if (not bool(value)) and schema:  # check the schema is active and there is some value in response
             raise Exception("Invalid value")
+        if path is None or not schema:
+            return
+        request = request.lower()
+        route = (request, ApiServer.routeTemplate(path.partition("?")[0].split("/")))
+        self.responses[route] = self.responses.get(route, 0) + 1
+        if self.responses[route] % self.sampleRate:
+            return
+        if value["statusCode"] >= 300:
+            validator = self.errorValidator
+        elif "?" in path:
+            validator = self.queryValidator
+        elif data and data.get("stream"):
+            validator = self.streamValidator
+        elif data and "limit" in data:
+            validator = self.pageValidators.get(route)
+        else:
+            validator = self.validators.get((request, "*")) or self.validators.get(route)
+        if validator is not None and not validator(value):
+            raise Exception(f"Invalid value for {request} {path}")
 
 class AccessToken(DefaultObjects): # this object exists as the end of chain
+    __slots__ = ()
+    registryKey = "accessTokens"
+
     def __init__(self, token_id: str, name: str):
         super().__init__(token_id, name)
 
 class User(DefaultObjects):
+    __slots__ = ("customerId", "accessTokens")
+    registryKey = "users"
+
     def __init__(self, user_id: str, name: str, customerId: str, accessTokens: Optional[list[str]] = None):
         super().__init__(user_id, name)
         self.customerId = customerId
@@ -48,71 +262,171 @@ class User(DefaultObjects):
             accessTokens = {}
         self.accessTokens = accessTokens
 
-    def createChild(self, name: Optional[str] = None) -> str:
-        tokenId = str(uuid4())
+    def createChild(self, name: Optional[str] = None, childId: Optional[str] = None) -> str:
+        tokenId = childId or str(uuid4())
         if name is None:
             name = f"Token {len(self.accessTokens)+1}"
-        newToken = AccessToken(tokenId, name)
-        testObjects["accessTokens"][tokenId] = newToken
-        self.accessTokens.update({tokenId: {}})
-        MainServer.database["customers"][self.customerId]["users"][self.id]["accessTokens"] = self.accessTokens
+        AccessToken(tokenId, name).register()
+        ownerIndex["accessTokens"][tokenId] = self.id
+        MainFeed.publish("attach", f"{self.getPath()}/accessTokens/{tokenId}", LeafNode, self.accessTokens)
         return tokenId
 
+    def createChildren(self, count: int, names: Optional[list[str]] = None, childIds: Optional[list[str]] = None) -> tuple[str, ...]:
+        # mint many tokens at once, each registry and the server get one update for the whole lot
+        # a count that isn't a whole number of at least 0, or names or ids that don't match it, raise a ValueError
+        # before anything is made, a name of None is given the default name as createChild would
+        if not isinstance(count, int) or isinstance(count, bool) or count < 0:
+            raise ValueError(f"Invalid count {count!r}")
+        if names is not None and len(names) != count or childIds is not None and len(childIds) != count:
+            raise ValueError(f"Expected {count} names and ids")
+        start = len(self.accessTokens) + 1
+        names = [f"Token {start + number}" if name is None else name for number, name in enumerate(names or [None] * count)]
+        for name in names:
+            checkName(name)
+        tokenIds = childIds or generateIds(count)
+        testObjects["accessTokens"].update({tokenId: AccessToken(tokenId, name) for tokenId, name in zip(tokenIds, names)})
+        queryIndexes["accessTokens"]["name"].addMany(zip(names, tokenIds))
+        ownerIndex["accessTokens"].update(dict.fromkeys(tokenIds, self.id))
+        MainFeed.publish("attachMany", f"{self.getPath()}/accessTokens", dict.fromkeys(tokenIds, LeafNode), self.accessTokens)
+        return tuple(tokenIds)
+
+    def getPath(self) -> str:
+        return f"customers/{self.customerId}/users/{self.id}"
+
     def getAccessTokens(self) -> list[str]:
         return self.accessTokens
 
-    def deleteAccessToken(self, token: str) -> None:
-        del self.accessTokens[token]  # code here fix from original design so tests run clean
+    def deleteAccessToken(self, token: str) -> DeleteHandle:
+        handle = DeleteHandle()  # code here fix from original design so tests run clean
+        MainFeed.publish("delete", "accessTokens", token, f"{self.getPath()}/accessTokens/{token}", self.accessTokens, False, handle)
+        return handle
+
+    def deleteChild(self, childId: str, background: bool = False) -> DeleteHandle:
+        return self.deleteAccessToken(childId)  # a token has nothing below it so there is never anything to wait for
 
 
 class Customer(DefaultObjects):
+    __slots__ = ("row", "users")
+    registryKey = "customers"
 
     def __init__(self, customer_id: str, name: str, version: int):
         super().__init__(customer_id, name)
-        self.version = version
+        self.row = versionColumn.allocate(customer_id, version)  # the version is kept in the shared version column
         self.users = {}
 
-    def createChild(self, name: str) -> str:
-        userId = str(uuid4())
-        newUser = User(userId, name, self.id)
-        testObjects["users"][userId] = newUser
-        self.users.update({userId: {}})
-        MainServer.database["customers"][self.id]["users"] = self.users
+    def __del__(self) -> None:
+        versionColumn.free(self.row)  # the row goes back to the column once nothing refers to the customer
+
+    @property
+    def version(self) -> int:
+        return versionColumn.getVersion(self.row)
+
+    @version.setter
+    def version(self, version: int) -> None:
+        versionColumn.setVersion(self.row, version)
+        if testObjects["customers"].get(self.id) is self:
+            MainFeed.publish("versions", [self.row])
+            logVersions([self.row])
+
+    def createChild(self, name: str, childId: Optional[str] = None) -> str:
+        userId = childId or str(uuid4())
+        User(userId, name, self.id).register()
+        ownerIndex["users"][userId] = self.id
+        MainFeed.publish("attach", f"customers/{self.id}/users/{userId}", {}, self.users)
         return userId
 
     def getUsers(self) -> list[str]:
         return list(self.users.keys())
 
-    def deleteUser(self, user_id: str) -> None:
-        self.users.pop(user_id)
+    def deleteUser(self, user_id: str, background: bool = False) -> DeleteHandle:
+        # the user and all of its tokens are removed
+        handle = DeleteHandle()
+        MainFeed.publish("delete", "users", user_id, f"customers/{self.id}/users/{user_id}", self.users, background, handle)
+        return handle
+
+    def deleteChild(self, childId: str, background: bool = False) -> DeleteHandle:
+        return self.deleteUser(childId, background)
 
 
 class Channel(DefaultObjects):
+    __slots__ = ("customers", "code")
+    registryKey = "channels"
+
     def __init__(self, channel_id: str, name: str):
         super().__init__(channel_id, name)
         self.customers: dict[str, dict] = {}
-        ManagementServer.database["channels"].update({channel_id: {"customers": self.customers}})
-        testObjects["channels"][channel_id] = self
+        self.code = versionColumn.channelCode()  # marks the channel's customers in the version column
+        with locks.channel(channel_id):
+            ManagementServer.attachNode(f"channels/{channel_id}", {"customers": self.customers})
+        self.register()
+        if ManagementServer.writeAheadLog is not None:  # channels aren't made through a command so log them here
+            ManagementServer.logWrite("channel", f"channels/{channel_id}", {"name": name}, {})
 
-    def createChild(self, name: str) -> str:
-        customerId = str(uuid4())
+    def createChild(self, name: str, childId: Optional[str] = None) -> str:
+        customerId = childId or str(uuid4())
         newCustomer = Customer(customerId, name, 1)
-        testObjects["customers"][customerId] = newCustomer
-        self.customers.update({customerId: {}})
-        ManagementServer.database["channels"][self.id]["customers"] = self.customers
-        MainServer.database["customers"].update({customerId: {"users": newCustomer.users}})
+        newCustomer.register()
+        versionColumn.assignChannel(newCustomer.row, self.code)
+        ownerIndex["customers"][customerId] = self.id
+        with locks.channel(self.id):
+            ManagementServer.attachNode(f"channels/{self.id}/customers/{customerId}", {}, self.customers)
+        MainFeed.publish("attach", f"customers/{customerId}", {"users": newCustomer.users}, None)
         return customerId
 
     def getCustomers(self) -> list[str]:
         return list(self.customers.keys())
 
-    def deleteCustomer(self, customerId: str) -> None:
-        self.customers.pop(customerId)
-        ManagementServer.database["channels"][self.id]["customers"] = self.customers
-        MainServer.database["customers"].pop(customerId)
+    def deleteCustomer(self, customerId: str, background: bool = False) -> DeleteHandle:
+        # the customer, its users and their tokens are removed
+        with locks.channel(self.id):
+            if customerId in self.customers:
+                ManagementServer.detachNode(f"channels/{self.id}/customers/{customerId}", self.customers)
+        customer = testObjects["customers"].get(customerId)
+        if customer is not None:
+            versionColumn.assignChannel(customer.row, noChannel)  # out of the channel's rollouts straight away
+        handle = DeleteHandle()
+        MainFeed.publish("delete", "customers", customerId, f"customers/{customerId}", None, background, handle)
+        return handle
+
+    def deleteChild(self, childId: str, background: bool = False) -> DeleteHandle:
+        return self.deleteCustomer(childId, background)
+
+    def delete(self, background: bool = False) -> DeleteHandle:
+        # the channel and every customer, user and token below it are removed
+        # only the delete that detaches the channel goes on, another one racing it finds it gone and has nothing to do
+        handle = DeleteHandle()
+        with locks.channel(self.id):
+            if ManagementServer.routes.get(f"channels/{self.id}") is None:
+                handle.finished.set()
+                return handle
+            ManagementServer.detachNode(f"channels/{self.id}")
+            customerIds = list(self.customers)
+        for customerId in customerIds:
+            customer = testObjects["customers"].get(customerId)
+            if customer is not None:
+                versionColumn.assignChannel(customer.row, noChannel)
+        MainFeed.publish("deleteChannel", self.id, customerIds, background, handle)
+        return handle
 
     def updateCustomerVersion(self, customer_id: str) -> None:
         testObjects["customers"][customer_id].version += 1
 
     def downgradeCustomerVersion(self, customer_id: str) -> None:
         testObjects["customers"][customer_id].version -= 1
+
+    def updateCustomerVersions(self, fromVersion: Optional[int] = None, percentage: float = 100) -> int:
+        # upgrade every customer of the channel in one operation, or only those on one version or a percentage of them
+        rows = versionColumn.rolloutRows(1, self.code, fromVersion, percentage)
+        MainFeed.publish("versions", rows)  # the rows moved, not one change per customer
+        logVersions(rows)
+        return len(rows)
+
+    def downgradeCustomerVersions(self, fromVersion: Optional[int] = None, percentage: float = 100) -> int:
+        rows = versionColumn.rolloutRows(-1, self.code, fromVersion, percentage)
+        MainFeed.publish("versions", rows)
+        logVersions(rows)
+        return len(rows)
+
+    def getVersionHistogram(self) -> dict[int, int]:
+        # how many of the channel's customers are on each version
+        return versionColumn.histogram(self.code)
@@ -0,0 +1,218 @@
+import json
+import mmap
+import os
+import threading
+from typing import Any, Callable, Iterator, Optional
+from databaseObjects import testObjects, ownerRegistry
+from objects import Channel, MainServer, ManagementServer
+
+
+class WriteAheadLog:  # append only file of every write made through the servers, one json record per line
+
+    def __init__(self, path: str, groupSize: int = 64, sequence: int = 0, flushInterval: float = 0.05):
+        self.path = path
+        self.groupSize = groupSize  # records are fsynced together once this many are waiting
+        self.flushInterval = flushInterval  # a group that never fills is still fsynced once it has waited this long
+        self.sequence = max(sequence, self.lastSequence())  # carry on numbering from an existing log or snapshot
+        self.pending = 0
+        self.file = open(path, "ab")
+        self.lock = threading.Lock()  # servers handling requests on several threads share one log
+        self.closed = threading.Event()
+        self.flusher = threading.Thread(target=self.flushIdle, name="wal-flusher", daemon=True)
+        self.flusher.start()
+
+    def lastSequence(self) -> int:
+        sequence = 0
+        for record in readLog(self.path):
+            sequence = record["sequence"]
+        return sequence
+
+    def append(self, record: dict[str, Any]) -> int:
+        # hand the record to the os straight away so it outlives a crash of the process
+        # but only fsync when a whole group is waiting or the flusher finds it has waited too long
+        with self.lock:
+            self.sequence += 1
+            record["sequence"] = self.sequence
+            self.file.write(json.dumps(record, separators=(",", ":")).encode() + b"\n")
+            self.file.flush()
+            self.pending += 1
+            if self.pending >= self.groupSize:
+                self.sync()
+            return self.sequence
+
+    def sync(self) -> None:
+        # the caller must hold the lock
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.pending = 0
+
+    def flushIdle(self) -> None:
+        # fsync whatever is waiting every flushInterval seconds until the log is closed
+        while not self.closed.wait(self.flushInterval):
+            with self.lock:
+                if self.pending:
+                    self.sync()
+
+    def flush(self) -> None:
+        with self.lock:
+            self.sync()
+
+    def rewrite(self, snapshot: Callable[[int], None]) -> int:
+        # snapshot everything logged so far and start the file again, numbering carries on
+        # appends wait for both so no record can be written in between and dropped without being in the snapshot
+        with self.lock:
+            self.sync()
+            snapshot(self.sequence)
+            self.file.truncate(0)
+            return self.sequence
+
+    def close(self) -> None:
+        self.closed.set()
+        self.flusher.join()
+        self.flush()
+        self.file.close()
+
+
+def readLog(path: str, after: int = 0) -> Iterator[dict[str, Any]]:
+    # yield the records in a log that come after the given sequence number
+    if not os.path.exists(path):
+        return
+    with open(path, "rb") as file:
+        for line in file:
+            try:
+                record = json.loads(line)
+            except ValueError:  # a torn last line from a crash mid write is ignored
+                break
+            if record["sequence"] > after:
+                yield record
+
+
+def listed(items: Any) -> list[Any]:
+    # a copy of a registry or node to walk while writers go on changing it
+    while True:
+        try:
+            return list(items)
+        except RuntimeError:  # it changed size while it was copied so copy it again
+            continue
+
+
+def writeSnapshot(path: str, sequence: int) -> None:
+    # write every object reachable from the channels as one compact json line each, parents before children
+    # the registries are walked while writes go on, anything deleted part way through is left out
+    temporaryPath = f"{path}.tmp"
+    with open(temporaryPath, "wb") as file:
+        def write(record: dict[str, Any]) -> None:
+            file.write(json.dumps(record, separators=(",", ":")).encode() + b"\n")
+
+        write({"sequence": sequence})
+        for channel in listed(testObjects["channels"].values()):
+            write({"type": "channels", "id": channel.id, "name": channel.name})
+            for customerId in listed(channel.customers):
+                customer = testObjects["customers"].get(customerId)
+                if customer is None:  # deleted through the main server but still listed by the channel
+                    continue
+                write({"type": "customers", "id": customerId, "name": customer.name, "version": customer.version, "owner": channel.id})
+                for userId in listed(customer.users):
+                    user = testObjects["users"].get(userId)
+                    if user is None:
+                        continue
+                    write({"type": "users", "id": userId, "name": user.name, "owner": customerId})
+                    for tokenId in listed(user.accessTokens):
+                        token = testObjects["accessTokens"].get(tokenId)
+                        if token is not None:
+                            write({"type": "accessTokens", "id": tokenId, "name": token.name, "owner": userId})
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temporaryPath, path)  # readers only ever see a complete snapshot
+
+
+def loadSnapshot(path: str) -> int:
+    # memory map a snapshot and rebuild its objects, returns the log sequence number the snapshot covers
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return 0
+    with open(path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        sequence = json.loads(mapped.readline())["sequence"]
+        for line in iter(mapped.readline, b""):
+            record = json.loads(line)
+            if record["type"] == "channels":
+                Channel(record["id"], record["name"])
+                continue
+            parent = testObjects[ownerRegistry[record["type"]]][record["owner"]]
+            parent.createChild(record["name"], record["id"])
+            if record["type"] == "customers":
+                testObjects["customers"][record["id"]].version = record["version"]
+    return sequence
+
+
+class Persistence:  # keeps both servers recoverable from a snapshot plus the log of writes made since it was taken
+
+    def __init__(self, directory: str, groupSize: int = 64, snapshotInterval: int = 100000):
+        self.snapshotPath = os.path.join(directory, "snapshot.jsonl")
+        self.logPath = os.path.join(directory, "writes.log")
+        self.groupSize = groupSize
+        self.snapshotInterval = snapshotInterval  # a new snapshot is taken after this many logged writes
+        self.servers = {server.name: server for server in (ManagementServer, MainServer)}
+        self.snapshotSequence = 0
+        self.log: Optional[WriteAheadLog] = None
+        self.skipped: list[dict[str, Any]] = []  # log records recover could not apply, kept for an operator to look at
+
+    def recover(self) -> int:
+        # rebuild the servers from the snapshot, replay only the log tail and start logging, returns the writes replayed
+        self.snapshotSequence = loadSnapshot(self.snapshotPath)
+        replayed = 0
+        for record in readLog(self.logPath, self.snapshotSequence):
+            try:
+                applied = self.replay(record)
+            except (AttributeError, KeyError, TypeError):  # a record that no longer fits the tree must not stop a restart
+                applied = False
+            if applied:
+                replayed += 1
+            else:
+                self.skipped.append(record)
+        self.log = WriteAheadLog(self.logPath, self.groupSize, self.snapshotSequence)
+        for server in self.servers.values():
+            server.writeAheadLog = self
+        return replayed
+
+    def replay(self, record: dict[str, Any]) -> bool:
+        # apply one logged write again, returns False for a write whose parent is missing
+        if record["request"] == "channel":
+            Channel(record["path"].split("/")[1], record["name"])
+            return True
+        if record["request"] == "versions":  # the versions customers were moved to, a customer deleted since is passed over
+            for customerId, version in record["versions"].items():
+                customer = testObjects["customers"].get(customerId)
+                if customer is not None:
+                    customer.version = version
+            return True
+        if record["request"] == "post":
+            registry, parentId = record["from"]
+            parent = testObjects[registry].get(parentId)
+            if parent is None:
+                return False
+            if "count" in record:
+                parent.createChildren(record["count"], record["names"], record["result"])
+            else:
+                parent.createChild(record["name"], record["result"])
+            return True
+        server = self.servers[record["server"]]
+        data = {"name": record["name"]} if record["request"] == "put" else None
+        server.routeCommand(record["request"], server.seperatePath(record["path"]), data)
+        return True
+
+    def append(self, record: dict[str, Any]) -> int:
+        # the servers send their writes here so a snapshot can be taken once enough have built up
+        sequence = self.log.append(record)
+        if sequence - self.snapshotSequence >= self.snapshotInterval:
+            self.checkpoint()
+        return sequence
+
+    def checkpoint(self) -> None:
+        # snapshot everything and drop the log records the snapshot now covers
+        self.snapshotSequence = self.log.rewrite(lambda sequence: writeSnapshot(self.snapshotPath, sequence))
+
+    def close(self) -> None:
+        for server in self.servers.values():
+            server.writeAheadLog = None
+        if self.log is not None:
+            self.log.close()
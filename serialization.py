@@ -0,0 +1,80 @@
+import json
+import threading
+from collections import OrderedDict
+from collections.abc import Iterator, Mapping
+from typing import Any, Optional
+from cascade import DeleteHandle
+
+cacheableKeys = {"ifNoneMatch"}  # a get with nothing else in its data reads the whole node so its bytes can be reused
+
+
+def encodeValue(value: Any) -> Any:
+    # json only knows plain dicts so snapshot views, streamed children and delete handles are turned into them
+    if isinstance(value, Mapping):
+        return dict(value.items())
+    if isinstance(value, Iterator):
+        return dict(value)
+    if isinstance(value, DeleteHandle):
+        return {"total": value.total, "removed": value.removed, "done": value.done()}
+    raise TypeError(f"{type(value).__name__} can not be encoded")
+
+
+def encodeResponse(response: dict[str, Any]) -> bytes:
+    while True:
+        try:
+            return json.dumps(response, separators=(",", ":"), default=encodeValue).encode()
+        except RuntimeError:  # a writer changed a node while it was encoded so encode it again
+            continue
+
+
+class ResponseEncoder:  # turns a server's responses into bytes and keeps the bytes of recently read nodes
+
+    def __init__(self, server: Any, maxBytes: int = 64 * 1024 * 1024):
+        self.server = server
+        self.maxBytes = maxBytes  # the least recently read nodes are dropped once the cached bytes go over this
+        self.size = 0
+        self.entries: OrderedDict[str, tuple[int, bytes]] = OrderedDict()  # path to the node version and its bytes
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def sendCommand(self, request: str, path: str, data: Optional[dict[str, Any]] = None) -> bytes:
+        # send a command to the server and return the encoded response
+        return self.send(request, path, data)[1]
+
+    def send(self, request: str, path: str, data: Optional[dict[str, Any]] = None) -> tuple[dict[str, Any], bytes]:
+        # the response along with its bytes, a whole node read is only encoded again once its version has moved on
+        # a get with no version such as a query or the metrics is encoded every time
+        response = self.server.sendCommand(request, path, data)
+        version = response.get("version")
+        if (response["statusCode"] != 200 or request.lower() != "get" or version is None
+                or (data and not data.keys() <= cacheableKeys)):
+            return response, encodeResponse(response)
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None and entry[0] == version:
+                self.entries.move_to_end(path)
+                self.hits += 1
+                return response, entry[1]
+        self.misses += 1
+        encoded = encodeResponse(response)
+        self.store(path, version, encoded)
+        return response, encoded
+
+    def store(self, path: str, version: int, encoded: bytes) -> None:
+        if len(encoded) > self.maxBytes:
+            return
+        with self.lock:
+            previous = self.entries.pop(path, None)
+            if previous is not None:
+                self.size -= len(previous[1])
+            self.entries[path] = (version, encoded)
+            self.size += len(encoded)
+            while self.size > self.maxBytes:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
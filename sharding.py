@@ -0,0 +1,237 @@
+import multiprocessing
+import os
+import threading
+import zlib
+from typing import Any, Optional
+from cascade import DeleteHandle
+from columns import versionColumn
+from databaseObjects import testObjects, ownerIndex, ownerRegistry
+from objects import Customer, MainFeed, MainServer, deleteFromMain
+
+
+def applyShardChange(kind: str, payload: tuple[Any, ...]) -> None:
+    # inside a worker, copy one change from the router into this shard's main server
+    if kind == "customer":
+        customerId, name, version = payload
+        customer = Customer(customerId, name, version)
+        customer.register()
+        MainServer.attachNode(f"customers/{customerId}", {"users": customer.users})
+    elif kind == "user":
+        customerId, userId, name = payload
+        testObjects["customers"][customerId].createChild(name, userId)
+    elif kind == "tokens":
+        userId, tokenIds, names = payload
+        testObjects["users"][userId].createChildren(len(tokenIds), names, tokenIds)
+    elif kind == "delete":
+        registryKey, objectId, path = payload
+        deleteFromMain(registryKey, objectId, path, None, False, DeleteHandle())
+    elif kind == "rename":
+        registryKey, objectId, name = payload
+        entity = testObjects[registryKey].get(objectId)
+        if entity is not None:
+            entity.name = name
+    elif kind == "versions":
+        for customerId, version in payload:
+            customer = testObjects["customers"].get(customerId)
+            if customer is not None:
+                customer.version = version
+
+
+def runShard(connection: Any) -> None:
+    # serve one shard of the main server in a worker process until told to stop
+    # changes are not answered so the router never waits on them, commands and batches are
+    while True:
+        kind, payload = connection.recv()
+        if kind == "stop":
+            break
+        elif kind == "command":
+            connection.send(MainServer.sendCommand(*payload))
+        elif kind == "batch":
+            connection.send(MainServer.sendBatch(payload))
+        else:
+            applyShardChange(kind, payload)
+    connection.close()
+
+
+class ShardRouter:  # spreads the main server's customers over worker processes by a hash of the customer id
+
+    def __init__(self, shardCount: Optional[int] = None):
+        # writes still go through this process's objects and main server, every change they make is also sent to
+        # the shard that owns the customer so reads can be served by the workers in parallel
+        # that includes renames and version changes as the shards answer queries from their own indexes
+        shardCount = shardCount or os.cpu_count() or 1
+        context = multiprocessing.get_context("spawn")  # workers start empty rather than with a copy of this process
+        self.connections = []
+        self.locks = []  # the change feed may forward from its own thread so each pipe is used by one thread at a time
+        self.processes = []
+        for number in range(shardCount):
+            routerEnd, workerEnd = context.Pipe()
+            process = context.Process(target=runShard, args=(workerEnd,), name=f"shard-{number}", daemon=True)
+            process.start()
+            workerEnd.close()
+            self.connections.append(routerEnd)
+            self.locks.append(threading.Lock())
+            self.processes.append(process)
+        self.previousApply = MainFeed.apply
+        MainFeed.apply = self.applyChange
+        self.seed()
+
+    def shardFor(self, customerId: str) -> int:
+        # crc32 rather than hash() so every process agrees on where a customer lives
+        return zlib.crc32(customerId.encode()) % len(self.connections)
+
+    def send(self, shard: int, kind: str, payload: Any) -> None:
+        with self.locks[shard]:
+            self.connections[shard].send((kind, payload))
+
+    def request(self, shard: int, kind: str, payload: Any) -> Any:
+        with self.locks[shard]:
+            self.connections[shard].send((kind, payload))
+            return self.connections[shard].recv()
+
+    def seed(self) -> None:
+        # copy the customers that already exist into their shards
+        for customerId, customerNode in MainServer.database["customers"].items():
+            customer = testObjects["customers"].get(customerId)
+            if customer is None:
+                continue
+            shard = self.shardFor(customerId)
+            self.send(shard, "customer", (customerId, customer.name, customer.version))
+            for userId, userNode in customerNode["users"].items():
+                self.send(shard, "user", (customerId, userId, testObjects["users"][userId].name))
+                tokenIds = list(userNode.get("accessTokens", {}))
+                if tokenIds:
+                    self.send(shard, "tokens", (userId, tokenIds, [testObjects["accessTokens"][tokenId].name for tokenId in tokenIds]))
+
+    @staticmethod
+    def customerOf(registryKey: str, objectId: str) -> Optional[str]:
+        # follow the owner index up to the customer an object belongs to, None for anything above a customer
+        while registryKey != "customers":
+            objectId = ownerIndex.get(registryKey, {}).get(objectId)
+            registryKey = ownerRegistry.get(registryKey)
+            if objectId is None or registryKey is None:
+                return None
+        return objectId
+
+    def applyChange(self, kind: str, arguments: tuple[Any, ...]) -> None:
+        # apply a change from the feed to this process's main server then forward it to the customer's shard
+        self.previousApply(kind, arguments)
+        if kind == "rename":
+            registryKey, objectId = arguments
+            customerId = self.customerOf(registryKey, objectId)
+            entity = testObjects[registryKey].get(objectId)
+            if customerId is not None and entity is not None:
+                self.send(self.shardFor(customerId), "rename", (registryKey, objectId, entity.name))
+            return
+        if kind == "versions":  # the rows a rollout moved, sent to each shard with the versions they are on now
+            changes: dict[int, list[tuple[str, int]]] = {}
+            for row in arguments[0]:
+                customerId = versionColumn.ids[row]
+                if customerId is not None:
+                    changes.setdefault(self.shardFor(customerId), []).append((customerId, versionColumn.getVersion(row)))
+            for shard, versions in changes.items():
+                self.send(shard, "versions", versions)
+            return
+        if kind == "deleteChannel":
+            for customerId in arguments[1]:
+                self.send(self.shardFor(customerId), "delete", ("customers", customerId, f"customers/{customerId}"))
+            return
+        path = arguments[2] if kind == "delete" else arguments[0]
+        segments = path.split("/")
+        shard = self.shardFor(segments[1])
+        if kind == "delete":
+            self.send(shard, "delete", arguments[:3])
+        elif kind == "attachMany":
+            tokenIds = list(arguments[1])
+            self.send(shard, "tokens", (segments[3], tokenIds, [testObjects["accessTokens"][tokenId].name for tokenId in tokenIds]))
+        elif len(segments) == 2:
+            customer = testObjects["customers"][segments[1]]
+            self.send(shard, "customer", (customer.id, customer.name, customer.version))
+        elif len(segments) == 4:
+            self.send(shard, "user", (segments[1], segments[3], testObjects["users"][segments[3]].name))
+        elif len(segments) == 6:
+            self.send(shard, "tokens", (segments[3], [segments[5]], [testObjects["accessTokens"][segments[5]].name]))
+
+    def sendCommand(self, request: str, path: str, data: Optional[dict[str, Any]] = None) -> dict[str, Any]:
+        # reads go to the shard owning the customer and a get of every customer, or a query over them, is fanned out
+        # to all of them and the results merged, paging every customer would need a cursor per shard so is refused
+        # a stream can't be sent between processes so the whole node is fetched and streamed from here
+        # writes go through this process's main server which forwards the changes they make
+        # anything not under customers, such as a query of every user or the metrics, is answered by that server too
+        # as it holds the whole tree and every index
+        request = request.lower()
+        if request != "get":
+            return MainServer.sendCommand(request, path, data)
+        segments = path.partition("?")[0].split("/")
+        if segments[0] != "customers":
+            return MainServer.sendCommand(request, path, data)
+        stream = bool(data and data.get("stream"))
+        if stream:
+            data = {key: value for key, value in data.items() if key != "stream"} or None
+        if len(segments) > 1:
+            response = self.request(self.shardFor(segments[1]), "command", (request, path, data))
+        elif data and "limit" in data:
+            return MainServer.generateResponse(400, {"message": "Paging every customer is not supported across shards"})
+        else:
+            response = self.fanOut(request, path, data)
+        if stream and response["statusCode"] == 200:
+            response["data"] = iter(response["data"].items())
+        return response
+
+    def fanOut(self, request: str, path: str, data: Optional[dict[str, Any]]) -> dict[str, Any]:
+        # send one command to every shard at once and merge the children they return, any failure is returned as is
+        for shard in range(len(self.connections)):
+            self.locks[shard].acquire()
+        try:
+            for connection in self.connections:
+                connection.send(("command", (request, path, data)))
+            responses = [connection.recv() for connection in self.connections]
+        finally:
+            for lock in self.locks:
+                lock.release()
+        merged = {}
+        for response in responses:
+            if response["statusCode"] != 200:
+                return response
+            merged.update(response["data"])
+        return MainServer.generateResponse(200, merged)
+
+    def sendBatch(self, operations: list[tuple[str, str, Optional[dict[str, Any]]]]) -> list[dict[str, Any]]:
+        # reads for customers are grouped by shard and the shards work on their groups at the same time
+        # everything else is handled in order as sendCommand would
+        responses: list[Optional[dict[str, Any]]] = [None] * len(operations)
+        groups: dict[int, list[int]] = {}
+        for index, (request, path, data) in enumerate(operations):
+            segments = path.split("/")
+            if request.lower() == "get" and segments[0] == "customers" and len(segments) > 1 and not (data and data.get("stream")):
+                groups.setdefault(self.shardFor(segments[1]), []).append(index)
+            else:
+                self.flushReads(operations, groups, responses)
+                responses[index] = self.sendCommand(request, path, data)
+        self.flushReads(operations, groups, responses)
+        return responses
+
+    def flushReads(self, operations: list[tuple[str, str, Optional[dict[str, Any]]]], groups: dict[int, list[int]],
+                   responses: list[Optional[dict[str, Any]]]) -> None:
+        for shard in sorted(groups):  # in the same order as fanOut so two threads never wait on each other's locks
+            self.locks[shard].acquire()
+        try:
+            for shard, indexes in groups.items():
+                self.connections[shard].send(("batch", [operations[index] for index in indexes]))
+            for shard, indexes in groups.items():
+                for index, response in zip(indexes, self.connections[shard].recv()):
+                    responses[index] = response
+        finally:
+            for shard in groups:
+                self.locks[shard].release()
+        groups.clear()
+
+    def close(self) -> None:
+        # stop the workers and go back to applying changes to this process only
+        MainFeed.apply = self.previousApply
+        for shard in range(len(self.connections)):
+            self.send(shard, "stop", None)
+        for process in self.processes:
+            process.join()
+        for connection in self.connections:
+            connection.close()
@@ -0,0 +1,88 @@
+from collections.abc import Mapping
+from typing import Any, Iterator
+
+Missing = object()  # recorded as the old value of a key that did not exist before a change
+
+
+class Snapshot:  # a consistent read only view of a server's database as it was at one version
+
+    def __init__(self, server: Any, version: int):
+        self.server = server
+        self.version = version
+
+    def valueAt(self, node: dict[str, Any], key: str) -> Any:
+        # the value a key of a node had at this version, the first change made after it holds what was there before
+        changes = self.server.history.get(id(node))
+        if changes is not None:
+            for changeVersion, oldValue in changes[1].get(key, ()):
+                if changeVersion > self.version:
+                    return oldValue
+        return node.get(key, Missing)
+
+    def wrap(self, value: Any) -> Any:
+        return SnapshotView(self, value) if isinstance(value, dict) else value
+
+    def get(self, path: str) -> dict[str, Any]:
+        # look a path up as it was at this version, only the nodes along the path are touched
+        value = self.wrap(self.server.database)
+        try:
+            for segment in path.split("/"):
+                value = value[segment]
+        except (KeyError, TypeError):
+            return self.server.generateResponse(404, {"message": "Not found"})
+        return self.server.generateResponse(200, value)
+
+    def close(self) -> None:
+        self.server.releaseSnapshot(self)
+
+    def __enter__(self) -> "Snapshot":
+        return self
+
+    def __exit__(self, *exceptionDetails: Any) -> None:
+        self.close()
+
+
+class SnapshotView(Mapping):  # read only mapping over one node of the database at a snapshot's version
+    __slots__ = ("snapshot", "node")
+
+    def __init__(self, snapshot: Snapshot, node: dict[str, Any]):
+        self.snapshot = snapshot  # keeps the snapshot and so the history it needs alive as long as the view is
+        self.node = node
+
+    def __getitem__(self, key: str) -> Any:
+        value = self.snapshot.valueAt(self.node, key)
+        if value is Missing:
+            raise KeyError(key)
+        return self.snapshot.wrap(value)
+
+    def __contains__(self, key: object) -> bool:
+        return self.snapshot.valueAt(self.node, key) is not Missing
+
+    def keys(self) -> Any:
+        return list(iter(self))
+
+    def __iter__(self) -> Iterator[str]:
+        # start from the keys the node has now and undo whatever changed since the snapshot was taken
+        while True:
+            try:
+                keys = list(self.node)
+                break
+            except RuntimeError:  # a writer resized the node while it was copied so copy it again
+                continue
+        changes = self.snapshot.server.history.get(id(self.node))
+        if changes is None:
+            return iter(keys)
+        present = set(keys)
+        for key in list(changes[1]):
+            existed = self.snapshot.valueAt(self.node, key) is not Missing
+            if existed and key not in present:
+                keys.append(key)
+            elif not existed and key in present:
+                keys.remove(key)
+        return iter(keys)
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+    def __repr__(self) -> str:
+        return f"SnapshotView({dict(self.items())!r})"
@@ -1,7 +1,25 @@
 import unittest
 import copy
-from objects import Channel
-from databaseObjects import testObjects
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+from unittest import mock
+from objects import Channel, MainServer, ManagementServer, LeafNode, MainFeed, Schema
+from databaseObjects import testObjects, ownerIndex
+from persistence import Persistence, WriteAheadLog, readLog
+from apiServer import ApiServer
+from sharding import ShardRouter
+from locking import locks
+from benchmarks import buildHierarchy, runWorkload, compareResults, readHttpResponse
+from serialization import ResponseEncoder
+from columns import VersionColumn, numpy
+from httpServer import HttpFrontEnd
+from http.client import HTTPConnection
+from snapshots import Missing
 
 # Setup Functions
 
@@ -40,6 +58,41 @@ class test_access_tokens(unittest.TestCase):
 
         self.assertEqual(tokenName, expectedName)
 
+    def test_tokens_use_compact_storage(self):
+        tokenId = self.defaultUser.createChild("Compact Token")
+
+        self.assertFalse(hasattr(testObjects["accessTokens"][tokenId], "__dict__"))
+        self.assertIs(LeafNode, self.defaultUser.getAccessTokens()[tokenId])
+
+
+    def test_bulk_mint_tokens(self):
+        self.defaultUser.createChild("Existing Token")
+
+        tokenIds = self.defaultUser.createChildren(3)
+
+        self.assertEqual(3, len(set(tokenIds)))
+        self.assertEqual(["Token 2", "Token 3", "Token 4"], [testObjects["accessTokens"][tokenId].name for tokenId in tokenIds])
+        for tokenId in tokenIds:
+            self.assertIn(tokenId, self.defaultUser.getAccessTokens())
+            self.assertEqual(self.defaultUser.id, ownerIndex["accessTokens"][tokenId])
+            self.assertIs(LeafNode, MainServer.lookupNode(f"{self.defaultUser.getPath()}/accessTokens/{tokenId}"))
+
+    def test_bulk_mint_tokens_through_post(self):
+        response = MainServer.sendCommand("post", "accessTokens", {"from": self.defaultUser, "count": 2, "names": ["First", "Second"]})
+
+        self.assertEqual(200, response["statusCode"])
+        Schema().checkValueAgainstSchema(response, "post", "accessTokens")
+        self.assertEqual(["First", "Second"], [testObjects["accessTokens"][tokenId].name for tokenId in response["data"]])
+        self.assertEqual(200, MainServer.sendCommand("get", f"{self.defaultUser.getPath()}/accessTokens/{response['data'][1]}")["statusCode"])
+
+
+    def test_bulk_mint_rejects_bad_count_and_names(self):
+        before = dict(self.defaultUser.getAccessTokens())
+        for data in ({"count": -1}, {"count": 3, "names": ["Only", "Two"]}, {"count": "many"}):
+            response = MainServer.sendCommand("post", "accessTokens", {"from": self.defaultUser, **data})
+
+            self.assertEqual(400, response["statusCode"])
+        self.assertEqual(before, self.defaultUser.getAccessTokens())
 
 class test_user_object(unittest.TestCase):
     
@@ -70,6 +123,13 @@ class test_user_object(unittest.TestCase):
         self.assertEqual(1, counter)
         self.assertEqual(tokenName, expectedName)
 
+    def test_query_access_token_by_name(self):
+        expectedName = "Test Token"
+        tokenId = self.defaultUser.createChild(expectedName)
+        response = MainServer.sendCommand("get", f"{self.defaultUser.getPath()}/accessTokens?name={expectedName}")
+
+        self.assertEqual({tokenId: expectedName}, response["data"])
+
     def test_get_access_tokens(self):
         tokenList = self.generate_tokens(self.defaultUser, 3)
 
@@ -193,3 +253,1129 @@ class test_channel_object(unittest.TestCase):
 
         self.assertEqual(customerVersion - 1, customerObject.version)
 
+
+class test_api_server(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.defaultUser = F_DEFAULT_USER()
+        self.defaultCustomer = testObjects["customers"][self.defaultUser.customerId]
+
+    def test_route_index_tracks_created_objects(self):
+        tokenId = self.defaultUser.createChild("Route Token")
+        tokenPath = f"{self.defaultUser.getPath()}/accessTokens/{tokenId}"
+
+        self.assertIs(MainServer.lookupNode(tokenPath), self.defaultUser.accessTokens[tokenId])
+        self.assertNotIn(tokenPath, MainServer.routes)  # leaves are found through their parent instead of a route each
+        self.assertEqual(200, MainServer.sendCommand("get", tokenPath)["statusCode"])
+        self.assertEqual(200, ManagementServer.sendCommand("get", f"channels/defaultChannel/customers/{self.defaultCustomer.id}")["statusCode"])
+
+    def test_route_index_drops_deleted_subtree(self):
+        tokenId = self.defaultUser.createChild("Route Token")
+        userPath = self.defaultUser.getPath()
+
+        response = MainServer.sendCommand("delete", f"customers/{self.defaultCustomer.id}/users/{self.defaultUser.id}")
+
+        self.assertEqual(200, response["statusCode"])
+        self.assertNotIn(userPath, MainServer.routes)
+        self.assertIs(Missing, MainServer.lookupNode(f"{userPath}/accessTokens/{tokenId}"))
+        self.assertEqual(404, MainServer.sendCommand("get", userPath)["statusCode"])
+        self.assertEqual(404, MainServer.sendCommand("delete", userPath)["statusCode"])
+
+    def test_send_batch_returns_response_per_operation(self):
+        tokenIds = [self.defaultUser.createChild(f"Batch Token{number}") for number in range(3)]
+        tokensPath = f"{self.defaultUser.getPath()}/accessTokens"
+        operations = [("DELETE", f"{tokensPath}/{tokenId}", None) for tokenId in tokenIds]
+        operations.append(("get", tokensPath, None))
+
+        responses = MainServer.sendBatch(operations)
+
+        self.assertEqual([200, 200, 200, 200], [response["statusCode"] for response in responses])
+        for tokenId in tokenIds:
+            self.assertNotIn(tokenId, responses[-1]["data"])
+
+    def test_atomic_batch_applies_nothing_on_failure(self):
+        tokenId = self.defaultUser.createChild("Batch Token")
+        tokenPath = f"{self.defaultUser.getPath()}/accessTokens/{tokenId}"
+        operations = [("delete", tokenPath, None), ("delete", tokenPath, None)]
+
+        responses = MainServer.sendBatch(operations, atomic=True)
+
+        self.assertEqual([424, 404], [response["statusCode"] for response in responses])
+        self.assertIn(tokenId, self.defaultUser.getAccessTokens())
+        self.assertIn(tokenId, testObjects["accessTokens"])
+
+    def test_atomic_batch_rejects_post_from_unknown_parent(self):
+        tokenId = self.defaultUser.createChild("Batch Token")
+        tokenPath = f"{self.defaultUser.getPath()}/accessTokens/{tokenId}"
+        operations = [("delete", tokenPath, None), ("post", "accessTokens", {"from": "not a user", "name": "Token"})]
+
+        responses = MainServer.sendBatch(operations, atomic=True)
+
+        self.assertEqual([424, 400], [response["statusCode"] for response in responses])
+        self.assertIn(tokenId, testObjects["accessTokens"])
+        self.assertEqual(400, MainServer.sendBatch(operations[1:])[0]["statusCode"])
+
+    def test_atomic_batch_undoes_applied_operations(self):
+        keptTokenId = self.defaultUser.createChild("Kept Token")
+        userPath = self.defaultUser.getPath()
+        MainServer.writeAheadLog = records = []
+        operations = [("put", userPath, {"name": "Renamed User"}),
+                      ("post", "accessTokens", {"from": self.defaultUser, "name": "Undone Token"}),
+                      ("delete", f"{userPath}/accessTokens/{keptTokenId}", None),
+                      ("post", "accessTokens", {"from": self.defaultUser, "count": "many"})]
+        try:
+            responses = MainServer.sendBatch(operations, atomic=True)
+        finally:
+            MainServer.writeAheadLog = None
+
+        self.assertEqual([424, 424, 424, 400], [response["statusCode"] for response in responses])
+        self.assertEqual("User1", self.defaultUser.name)
+        self.assertEqual(["Kept Token"], [testObjects["accessTokens"][tokenId].name for tokenId in self.defaultUser.getAccessTokens()])
+        self.assertEqual("Kept Token", testObjects["accessTokens"][keptTokenId].name)
+        self.assertEqual(200, MainServer.sendCommand("get", f"{userPath}/accessTokens/{keptTokenId}")["statusCode"])
+        self.assertEqual([], records)
+
+    def test_batch_groups_posts_and_gets(self):
+        names = [f"Grouped Token{number}" for number in range(3)]
+        operations = [("post", "accessTokens", {"from": self.defaultUser, "name": name}) for name in names]
+        before = MainServer.sendCommand("get", "_metrics")["data"]["routes"].get("customers/{id}/users/{id}/accessTokens/{id}", 0)
+
+        tokenIds = [response["data"] for response in MainServer.sendBatch(operations)]
+        reads = MainServer.sendBatch([("get", f"{self.defaultUser.getPath()}/accessTokens/{tokenId}", None) for tokenId in tokenIds])
+        after = MainServer.sendCommand("get", "_metrics")["data"]["routes"]["customers/{id}/users/{id}/accessTokens/{id}"]
+
+        self.assertEqual(names, [testObjects["accessTokens"][tokenId].name for tokenId in tokenIds])
+        self.assertEqual([200] * 3, [response["statusCode"] for response in reads])
+        self.assertEqual(3, after - before)
+
+    def test_batch_posts_name_tokens_as_single_posts_do(self):
+        tokenIds = set(testObjects["accessTokens"])
+        unnamed = {"from": self.defaultUser, "name": None}
+
+        rejected = MainServer.sendBatch([("post", "accessTokens", unnamed), ("post", "accessTokens", {"from": self.defaultUser, "name": 5})])
+        self.assertEqual([400, 400], [response["statusCode"] for response in rejected])
+        self.assertEqual(tokenIds, set(testObjects["accessTokens"]))  # nothing is made when one of the names is rejected
+
+        batched = MainServer.sendBatch([("post", "accessTokens", unnamed)])[0]
+        single = MainServer.sendCommand("post", "accessTokens", unnamed)
+
+        self.assertEqual(200, batched["statusCode"])
+        self.assertEqual(f"Token {len(self.defaultUser.getAccessTokens()) - 1}", testObjects["accessTokens"][batched["data"]].name)
+        self.assertEqual(f"Token {len(self.defaultUser.getAccessTokens())}", testObjects["accessTokens"][single["data"]].name)
+
+    def test_resolve_owner_of_access_token(self):
+        tokenId = self.defaultUser.createChild("Owned Token")
+
+        response = MainServer.resolveOwner(tokenId)
+
+        self.assertEqual(200, response["statusCode"])
+        self.assertEqual({"user": self.defaultUser.id, "customer": self.defaultCustomer.id, "channel": "defaultChannel"}, response["data"])
+
+    def test_resolve_owner_after_token_deleted(self):
+        tokenId = self.defaultUser.createChild("Owned Token")
+
+        MainServer.sendCommand("delete", f"{self.defaultUser.getPath()}/accessTokens/{tokenId}")
+
+        self.assertNotIn(tokenId, ownerIndex["accessTokens"])
+        self.assertEqual(404, MainServer.resolveOwner(tokenId)["statusCode"])
+
+    def get_all_pages(self, path, limit, between=None):
+        collected = []
+        cursor = None
+        while True:
+            response = MainServer.sendCommand("get", path, {"limit": limit, "cursor": cursor})
+            self.assertEqual(200, response["statusCode"])
+            collected.extend(response["data"]["items"])
+            cursor = response["data"]["cursor"]
+            if cursor is None:
+                return collected
+            if between is not None:
+                between()
+
+    def test_paginated_get_returns_every_child_once(self):
+        tokenList = [self.defaultUser.createChild(f"Page Token{number}") for number in range(5)]
+
+        collected = self.get_all_pages(f"{self.defaultUser.getPath()}/accessTokens", 2)
+
+        self.assertEqual(tokenList, collected)
+
+    def test_paginated_get_is_stable_under_writes(self):
+        tokenList = [self.defaultUser.createChild(f"Page Token{number}") for number in range(6)]
+        deletedToken = tokenList[0]
+
+        def write_between_pages():
+            if deletedToken in self.defaultUser.getAccessTokens():
+                self.defaultUser.deleteAccessToken(deletedToken)
+
+        collected = self.get_all_pages(f"{self.defaultUser.getPath()}/accessTokens", 2, write_between_pages)
+
+        self.assertEqual(tokenList, collected)
+
+    def test_paginated_get_resumes_by_position(self):
+        tokensPath = f"{self.defaultUser.getPath()}/accessTokens"
+        tokenList = [self.defaultUser.createChild(f"Page Token{number}") for number in range(4)]
+        first = MainServer.sendCommand("get", tokensPath, {"limit": 2})["data"]
+        keys = MainServer.childOrders[tokensPath]
+        tokenList.append(self.defaultUser.createChild("Late Token"))
+
+        second = MainServer.sendCommand("get", tokensPath, {"limit": 3, "cursor": first["cursor"]})["data"]
+
+        self.assertIs(keys, MainServer.childOrders[tokensPath])  # appends don't make the keys get listed again
+        self.assertEqual(tokenList, list(first["items"]) + list(second["items"]))
+        self.assertIsNone(second["cursor"])
+
+    def test_paginated_get_resumes_after_the_cursor_key_is_deleted(self):
+        tokensPath = f"{self.defaultUser.getPath()}/accessTokens"
+        tokenList = [self.defaultUser.createChild(f"Page Token{number}") for number in range(6)]
+        first = MainServer.sendCommand("get", tokensPath, {"limit": 2})["data"]
+        for tokenId in first["items"]:  # the cursor's own key and everything before it
+            self.defaultUser.deleteAccessToken(tokenId)
+
+        second = MainServer.sendCommand("get", tokensPath, {"limit": 2, "cursor": first["cursor"]})["data"]
+
+        self.assertEqual(tokenList[:2], list(first["items"]))
+        self.assertEqual(tokenList[2:4], list(second["items"]))
+
+    def test_streamed_get_resumes_after_the_last_key_is_deleted(self):
+        tokenList = [self.defaultUser.createChild(f"Stream Token{number}") for number in range(6)]
+        response = MainServer.sendCommand("get", f"{self.defaultUser.getPath()}/accessTokens", {"stream": True})
+        streamed = []
+        for tokenId, _ in response["data"]:
+            streamed.append(tokenId)
+            if len(streamed) == 2:
+                for deletedId in streamed:
+                    self.defaultUser.deleteAccessToken(deletedId)
+
+        self.assertEqual(tokenList, streamed)
+
+    def test_streamed_get_survives_writes_while_streaming(self):
+        tokenList = [self.defaultUser.createChild(f"Stream Token{number}") for number in range(3)]
+        response = MainServer.sendCommand("get", f"{self.defaultUser.getPath()}/accessTokens", {"stream": True})
+        streamed = []
+        for tokenId, _ in response["data"]:
+            streamed.append(tokenId)
+            if len(streamed) == 1:
+                tokenList.append(self.defaultUser.createChild("Late Token"))
+
+        self.assertEqual(tokenList, streamed)
+
+    def test_paginated_get_rejects_bad_cursor(self):
+        self.defaultUser.createChild("Page Token")
+
+        response = MainServer.sendCommand("get", f"{self.defaultUser.getPath()}/accessTokens", {"limit": 2, "cursor": "not a cursor"})
+
+        self.assertEqual(400, response["statusCode"])
+
+
+class test_persistence(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.directory = tempfile.TemporaryDirectory()
+        self.defaultCustomer = F_DEFAULT_CUSTOMER()
+
+    def tearDown(self) -> None:
+        self.directory.cleanup()
+
+    def test_log_groups_fsyncs(self):
+        log = WriteAheadLog(os.path.join(self.directory.name, "writes.log"), groupSize=2, flushInterval=60)
+        for number in range(3):
+            log.append({"request": "delete", "path": f"customers/{number}"})
+
+        self.assertEqual(1, log.pending)
+        log.close()
+        self.assertEqual([2, 3], [record["sequence"] for record in readLog(log.path, after=1)])
+
+    def test_log_writes_records_through_before_a_group_fills(self):
+        path = os.path.join(self.directory.name, "writes.log")
+        script = (
+            "import os, sys\n"
+            "from persistence import WriteAheadLog\n"
+            "log = WriteAheadLog(sys.argv[1], flushInterval=60)\n"
+            "for number in range(10):\n"
+            "    log.append({'request': 'delete', 'path': f'customers/{number}'})\n"
+            "os._exit(0)\n"
+        )
+        packageRoot = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        subprocess.run([sys.executable, "-c", script, path], cwd=packageRoot, check=True)
+
+        self.assertEqual(list(range(1, 11)), [record["sequence"] for record in readLog(path)])
+
+    def test_log_fsyncs_a_group_that_never_fills(self):
+        log = WriteAheadLog(os.path.join(self.directory.name, "writes.log"), groupSize=64, flushInterval=0.01)
+        log.append({"request": "delete", "path": "customers/1"})
+
+        for _ in range(100):
+            if not log.pending:
+                break
+            threading.Event().wait(0.01)
+        pending = log.pending
+        log.close()
+        self.assertEqual(0, pending)
+
+    def test_recover_from_snapshot_and_log_tail(self):
+        persistence = Persistence(self.directory.name)
+        persistence.recover()
+        persistence.checkpoint()
+        userId = MainServer.sendCommand("post", "users", {"name": "Saved User", "from": self.defaultCustomer})["data"]
+        user = testObjects["users"][userId]
+        tokenId = MainServer.sendCommand("post", "accessTokens", {"name": "Saved Token", "from": user})["data"]
+        MainServer.sendCommand("put", f"{user.getPath()}/accessTokens/{tokenId}", {"name": "Renamed Token"})
+        droppedId = MainServer.sendCommand("post", "accessTokens", {"name": "Dropped Token", "from": user})["data"]
+        MainServer.sendCommand("delete", f"{user.getPath()}/accessTokens/{droppedId}")
+        persistence.close()
+
+        script = (
+            "import json, sys\n"
+            "from persistence import Persistence\n"
+            "from databaseObjects import testObjects\n"
+            "from objects import MainServer\n"
+            "persistence = Persistence(sys.argv[1])\n"
+            "replayed = persistence.recover()\n"
+            "persistence.close()\n"
+            "tokens = MainServer.sendCommand('get', sys.argv[2])['data']\n"
+            "print(json.dumps({'replayed': replayed, 'tokens': list(tokens), 'name': testObjects['accessTokens'][sys.argv[3]].name}))\n"
+        )
+        packageRoot = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        output = subprocess.run([sys.executable, "-c", script, self.directory.name, f"{user.getPath()}/accessTokens", tokenId],
+                                cwd=packageRoot, capture_output=True, text=True, check=True).stdout
+        restored = json.loads(output)
+
+        self.assertEqual(5, restored["replayed"])
+        self.assertEqual([tokenId], restored["tokens"])
+        self.assertEqual("Renamed Token", restored["name"])
+
+    def test_recover_channel_made_after_snapshot(self):
+        persistence = Persistence(self.directory.name)
+        persistence.recover()
+        persistence.checkpoint()
+        channel = Channel("Logged Channel", "Logged Channel")
+        customerId = ManagementServer.sendCommand("post", "customers", {"name": "Logged Customer", "from": channel})["data"]
+        persistence.log.append({"server": "main", "request": "post", "path": "users",
+                                "from": ["customers", "missing customer"], "result": "orphan", "name": "Orphan"})
+        persistence.close()
+
+        script = (
+            "import json, sys\n"
+            "from persistence import Persistence\n"
+            "from databaseObjects import testObjects\n"
+            "persistence = Persistence(sys.argv[1])\n"
+            "replayed = persistence.recover()\n"
+            "persistence.close()\n"
+            "print(json.dumps({'replayed': replayed, 'skipped': len(persistence.skipped),\n"
+            "                  'customers': list(testObjects['channels']['Logged Channel'].customers)}))\n"
+        )
+        packageRoot = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        output = subprocess.run([sys.executable, "-c", script, self.directory.name],
+                                cwd=packageRoot, capture_output=True, text=True, check=True).stdout
+        restored = json.loads(output)
+
+        self.assertEqual({"replayed": 2, "skipped": 1, "customers": [customerId]}, restored)
+
+    def test_recover_version_changes(self):
+        channel = Channel("Versioned Channel", "Versioned Channel")
+        customerIds = [channel.createChild(f"Versioned Customer{number}") for number in range(3)]
+        persistence = Persistence(self.directory.name)
+        persistence.recover()
+        persistence.checkpoint()
+        channel.updateCustomerVersions()
+        channel.updateCustomerVersion(customerIds[0])
+        channel.downgradeCustomerVersions(fromVersion=2, percentage=100)
+        persistence.close()
+
+        script = (
+            "import json, sys\n"
+            "from persistence import Persistence\n"
+            "from databaseObjects import testObjects\n"
+            "persistence = Persistence(sys.argv[1])\n"
+            "persistence.recover()\n"
+            "persistence.close()\n"
+            "print(json.dumps([testObjects['customers'][customerId].version for customerId in sys.argv[2:]]))\n"
+        )
+        packageRoot = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        output = subprocess.run([sys.executable, "-c", script, self.directory.name, *customerIds],
+                                cwd=packageRoot, capture_output=True, text=True, check=True).stdout
+
+        self.assertEqual([3, 1, 1], json.loads(output))
+
+    def test_records_appended_during_a_checkpoint_are_kept(self):
+        log = WriteAheadLog(os.path.join(self.directory.name, "writes.log"), flushInterval=60)
+        log.append({"request": "delete", "path": "customers/1"})
+        appender = threading.Thread(target=log.append, args=({"request": "delete", "path": "customers/2"},))
+        covered = []
+
+        def snapshot(sequence):
+            appender.start()
+            appender.join(0.1)  # the append waits until the log has started again
+            covered.append(sequence)
+
+        log.rewrite(snapshot)
+        appender.join()
+        log.close()
+
+        self.assertEqual([1], covered)
+        self.assertEqual(["customers/2"], [record["path"] for record in readLog(log.path)])
+
+
+class test_benchmarks(unittest.TestCase):
+
+    def test_workload_reports_every_verb(self):
+        hierarchy = buildHierarchy(2, 2, 2, 2, prefix="test")
+        self.assertEqual(16, len(hierarchy["tokens"]))
+
+        results = runWorkload(hierarchy, 200, seed=1)
+
+        for verb in ("get", "post", "put", "delete"):
+            self.assertGreater(results["verbs"][verb]["count"], 0)
+            self.assertLessEqual(results["verbs"][verb]["p50"], results["verbs"][verb]["p99"])
+        self.assertEqual([], compareResults(results, results))
+
+
+class test_metrics(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.server = ApiServer({"customers": {"customer1": {"users": {}}}}, "metrics")
+
+    def test_metrics_count_routes_and_not_found(self):
+        self.server.sendCommand("get", "customers/customer1/users")
+        self.server.sendCommand("GET", "customers/missing/users")
+        self.server.sendCommand("patch", "customers")
+
+        metrics = self.server.sendCommand("get", "_metrics")["data"]
+
+        self.assertEqual({"get": 2, "patch": 1}, metrics["verbs"])
+        self.assertEqual({"customers/{id}/users": 2, "customers": 1}, metrics["routes"])
+        self.assertEqual({200: 1, 404: 1, 405: 1}, metrics["statusCodes"])
+        self.assertEqual(0.5, metrics["routeNotFoundRates"]["customers/{id}/users"])
+        self.assertEqual(2, sum(metrics["latencyHistograms"]["get"]))
+
+    def test_metrics_reuse_the_route_of_a_repeated_path(self):
+        for _ in range(3):
+            self.server.sendCommand("get", "customers/customer1/users")
+        self.server.sendCommand("get", "customers/customer1/users?colour=red")
+
+        route, counters = self.server.metrics.routeCache["get"]["customers/customer1/users"]
+
+        self.assertEqual("customers/{id}/users", route)
+        self.assertEqual({200: 3, 400: 1}, {statusCode: sum(buckets) for statusCode, buckets in counters.items()})
+
+    def test_metrics_can_be_switched_off(self):
+        self.server.disableMetrics()
+        self.server.sendCommand("get", "customers")
+
+        self.assertIsNone(self.server.metrics)
+        self.assertEqual(404, self.server.sendCommand("get", "_metrics")["statusCode"])
+
+
+class test_cascade_delete(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.defaultChannel = F_DEFAULT_CHANNEL()
+        self.customerId = self.defaultChannel.createChild("Cascade Customer")
+        customer = testObjects["customers"][self.customerId]
+        self.userIds = [customer.createChild(f"User{number}") for number in range(2)]
+        self.tokenIds = [testObjects["users"][userId].createChild() for userId in self.userIds for _ in range(2)]
+
+    def assert_subtree_removed(self):
+        self.assertNotIn(self.customerId, testObjects["customers"])
+        self.assertNotIn(self.customerId, ownerIndex["customers"])
+        for userId in self.userIds:
+            self.assertNotIn(userId, testObjects["users"])
+            self.assertNotIn(userId, ownerIndex["users"])
+        for tokenId in self.tokenIds:
+            self.assertNotIn(tokenId, testObjects["accessTokens"])
+            self.assertNotIn(tokenId, ownerIndex["accessTokens"])
+        self.assertFalse([route for route in MainServer.routes if route.startswith(f"customers/{self.customerId}")])
+
+    def test_delete_customer_removes_whole_subtree(self):
+        handle = self.defaultChannel.deleteCustomer(self.customerId)
+
+        self.assertTrue(handle.done())
+        self.assertEqual(7, handle.total)
+        self.assert_subtree_removed()
+
+    def test_background_delete_reports_completion(self):
+        response = MainServer.sendCommand("delete", f"customers/{self.customerId}", {"background": True})
+
+        self.assertEqual(202, response["statusCode"])
+        self.assertEqual(404, MainServer.sendCommand("get", f"customers/{self.customerId}")["statusCode"])
+        handle = response["data"]["handle"]
+        self.assertTrue(handle.wait(5))
+        self.assertEqual(1.0, handle.progress())
+        self.assertNotIn(self.customerId, self.defaultChannel.getCustomers())
+        self.assert_subtree_removed()
+
+
+    def test_delete_channel_removes_its_customers(self):
+        channel = Channel("Cascade Channel", "Cascade Channel")
+        customerId = channel.createChild("Channel Customer")
+        userId = testObjects["customers"][customerId].createChild("Channel User")
+        tokenId = testObjects["users"][userId].createChild("Channel Token")
+
+        response = ManagementServer.sendCommand("delete", "channels/Cascade Channel")
+
+        self.assertEqual(200, response["statusCode"])
+        self.assertEqual(404, ManagementServer.sendCommand("get", "channels/Cascade Channel")["statusCode"])
+        self.assertEqual(404, MainServer.sendCommand("get", f"customers/{customerId}")["statusCode"])
+        for registryKey, objectId in (("channels", "Cascade Channel"), ("customers", customerId), ("users", userId), ("accessTokens", tokenId)):
+            self.assertNotIn(objectId, testObjects[registryKey])
+            self.assertNotIn(objectId, ownerIndex.get(registryKey, {}))
+        self.assertIn(self.customerId, testObjects["customers"])  # other channels keep their customers
+
+
+class test_change_feed(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.defaultChannel = F_DEFAULT_CHANNEL()
+        MainFeed.start()
+
+    def tearDown(self) -> None:
+        MainFeed.stop()
+
+    def test_main_server_catches_up_with_changes(self):
+        customerId = self.defaultChannel.createChild("Replicated Customer")
+        self.assertTrue(MainFeed.waitFor(timeout=5))
+        user = testObjects["users"][testObjects["customers"][customerId].createChild("Replicated User")]
+        tokenId = user.createChild("Replicated Token")
+
+        self.assertTrue(MainFeed.waitFor(timeout=5))
+        self.assertEqual(0, MainFeed.lag()["pending"])
+        self.assertEqual(200, MainServer.sendCommand("get", f"{user.getPath()}/accessTokens/{tokenId}")["statusCode"])
+
+        handle = self.defaultChannel.deleteCustomer(customerId)
+
+        self.assertTrue(handle.wait(5))
+        self.assertEqual(404, MainServer.sendCommand("get", f"customers/{customerId}")["statusCode"])
+        self.assertNotIn(tokenId, testObjects["accessTokens"])
+        self.assertIsNone(MainFeed.lastError)
+
+
+class test_schema(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.defaultUser = F_DEFAULT_USER()
+        self.defaultUser.createChild("Schema Token")
+        self.schema = Schema()
+
+    def test_valid_responses_pass(self):
+        for path in (self.defaultUser.getPath(), f"{self.defaultUser.getPath()}/accessTokens", f"customers/{self.defaultUser.customerId}/users"):
+            self.schema.checkValueAgainstSchema(MainServer.sendCommand("get", path), "get", path)
+        self.schema.checkValueAgainstSchema(MainServer.sendCommand("get", "customers/missing"), "get", "customers/missing")
+
+    def test_paged_streamed_and_query_responses_pass(self):
+        path = f"{self.defaultUser.getPath()}/accessTokens"
+        for data in ({"limit": 1}, {"stream": True}):
+            self.schema.checkValueAgainstSchema(MainServer.sendCommand("get", path, data), "get", path, data)
+        queryPath = f"customers/{self.defaultUser.customerId}/users?name=User1"
+        self.schema.checkValueAgainstSchema(MainServer.sendCommand("get", queryPath), "get", queryPath)
+
+        with self.assertRaises(Exception):
+            self.schema.checkValueAgainstSchema({"statusCode": 200, "data": {"items": {"token": "not a node"}, "cursor": None}},
+                                                "get", path, {"limit": 1})
+
+    def test_wrong_shape_is_rejected(self):
+        path = f"{self.defaultUser.getPath()}/accessTokens"
+
+        with self.assertRaises(Exception):
+            self.schema.checkValueAgainstSchema({"statusCode": 200, "data": {"token": "not a node"}}, "get", path)
+
+    def test_sampling_only_checks_one_in_n(self):
+        self.schema = Schema(sampleRate=3)
+        path = f"{self.defaultUser.getPath()}/accessTokens"
+        badResponse = {"statusCode": 200, "data": {"token": "not a node"}}
+
+        self.schema.checkValueAgainstSchema(badResponse, "get", path)
+        self.schema.checkValueAgainstSchema(badResponse, "get", path)
+        with self.assertRaises(Exception):
+            self.schema.checkValueAgainstSchema(badResponse, "get", path)
+
+    def test_sampling_counts_each_route_separately(self):
+        self.schema = Schema(sampleRate=2)
+        path = f"{self.defaultUser.getPath()}/accessTokens"
+        badResponse = {"statusCode": 200, "data": {"token": "not a node"}}
+
+        self.schema.checkValueAgainstSchema(badResponse, "get", path)
+        self.schema.checkValueAgainstSchema(MainServer.sendCommand("get", "customers"), "get", "customers")
+        with self.assertRaises(Exception):
+            self.schema.checkValueAgainstSchema(badResponse, "get", path)
+
+
+class test_sharding(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.defaultChannel = F_DEFAULT_CHANNEL()
+        self.existingCustomerId = self.defaultChannel.createChild("Existing Customer")
+        self.router = ShardRouter(2)
+
+    def tearDown(self) -> None:
+        self.router.close()
+
+    def test_reads_are_served_by_shards(self):
+        newCustomerId = self.defaultChannel.createChild("Sharded Customer")
+        userId = self.router.sendCommand("post", "users", {"name": "Sharded User", "from": testObjects["customers"][newCustomerId]})["data"]
+        tokenIds = testObjects["users"][userId].createChildren(3)
+
+        allCustomers = self.router.sendCommand("get", "customers")
+        userResponse = self.router.sendCommand("get", f"customers/{newCustomerId}/users/{userId}")
+        batch = self.router.sendBatch([("get", f"customers/{self.existingCustomerId}", None),
+                                       ("get", f"customers/{newCustomerId}/users/{userId}/accessTokens/{tokenIds[0]}", None)])
+
+        self.assertIn(self.existingCustomerId, allCustomers["data"])
+        self.assertIn(newCustomerId, allCustomers["data"])
+        self.assertEqual(list(tokenIds), list(userResponse["data"]["accessTokens"]))
+        self.assertEqual([200, 200], [response["statusCode"] for response in batch])
+
+    def test_fan_out_merges_queries_and_streams_and_refuses_pages(self):
+        customerId = self.defaultChannel.createChild("Sharded Customer")
+        MainServer.sendCommand("put", f"customers/{customerId}", {"name": "Renamed Sharded Customer"})
+        self.defaultChannel.updateCustomerVersions()
+
+        renamed = self.router.sendCommand("get", "customers?name=Renamed Sharded Customer")
+        upgraded = self.router.sendCommand("get", "customers?version>=2")
+        streamed = dict(self.router.sendCommand("get", "customers", {"stream": True})["data"])
+        paged = self.router.sendCommand("get", "customers", {"limit": 1})
+
+        self.assertEqual({customerId: "Renamed Sharded Customer"}, renamed["data"])
+        self.assertIn(customerId, upgraded["data"])
+        self.assertIn(self.existingCustomerId, upgraded["data"])
+        self.assertIn(customerId, streamed)
+        self.assertIn(self.existingCustomerId, streamed)
+        self.assertEqual(400, paged["statusCode"])
+        self.assertEqual(400, self.router.sendCommand("get", "customers?colour=red")["statusCode"])
+
+    def test_answers_outside_customers_match_the_main_server(self):
+        customer = testObjects["customers"][self.existingCustomerId]
+        userId = customer.createChild("abbot")
+
+        everywhere = self.router.sendCommand("get", "users?name^=ab")
+
+        self.assertEqual(MainServer.sendCommand("get", "users?name^=ab")["data"], everywhere["data"])
+        self.assertIn(userId, everywhere["data"])
+        self.assertEqual(200, self.router.sendCommand("get", "_metrics")["statusCode"])
+        self.assertEqual(404, self.router.sendCommand("get", "missing")["statusCode"])
+
+    def test_batches_and_fan_outs_take_shard_locks_in_one_order(self):
+        customerIds = {}
+        while len(customerIds) < 2:
+            customerId = self.defaultChannel.createChild("Locked Customer")
+            customerIds.setdefault(self.router.shardFor(customerId), customerId)
+        reads = [("get", f"customers/{customerIds[shard]}", None) for shard in sorted(customerIds, reverse=True)]
+        errors = []
+
+        def run(target):
+            try:
+                for _ in range(50):
+                    target()
+            except Exception as error:
+                errors.append(error)
+
+        threads = [threading.Thread(target=run, args=(lambda: self.router.sendBatch(reads),), daemon=True),
+                   threading.Thread(target=run, args=(lambda: self.router.sendCommand("get", "customers"),), daemon=True)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(timeout=30)
+            self.assertFalse(thread.is_alive())
+        self.assertEqual([], errors)
+
+    def test_deletes_reach_the_shard(self):
+        self.router.sendCommand("delete", f"customers/{self.existingCustomerId}")
+
+        self.assertEqual(404, self.router.sendCommand("get", f"customers/{self.existingCustomerId}")["statusCode"])
+
+
+class test_concurrency(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.defaultUser = F_DEFAULT_USER()
+        self.switchInterval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)  # switch threads as often as possible to force contention
+        locks.enable()
+
+    def tearDown(self) -> None:
+        locks.disable()
+        sys.setswitchinterval(self.switchInterval)
+
+    @staticmethod
+    def run_threads(target, count):
+        errors = []
+
+        def guarded(number):
+            try:
+                target(number)
+            except Exception as error:
+                errors.append(error)
+
+        threads = [threading.Thread(target=guarded, args=(number,)) for number in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return errors
+
+    def test_no_lost_updates_or_torn_deletes(self):
+        created = [[] for _ in range(8)]
+
+        def create(number):
+            for _ in range(100):
+                created[number].append(MainServer.sendCommand("post", "accessTokens", {"name": "Stress Token", "from": self.defaultUser})["data"])
+
+        self.assertEqual([], self.run_threads(create, 8))
+        tokenIds = [tokenId for tokens in created for tokenId in tokens]
+        self.assertEqual(sorted(tokenIds), sorted(self.defaultUser.getAccessTokens()))
+        for tokenId in tokenIds:
+            self.assertIs(LeafNode, MainServer.lookupNode(f"{self.defaultUser.getPath()}/accessTokens/{tokenId}"))
+
+        deleted = [[] for _ in range(8)]
+
+        def delete(number):
+            for tokenId in tokenIds[number % 4::4]:  # every token is deleted by two threads at once
+                response = MainServer.sendCommand("delete", f"{self.defaultUser.getPath()}/accessTokens/{tokenId}")
+                if response["statusCode"] == 200:
+                    deleted[number].append(tokenId)
+
+        self.assertEqual([], self.run_threads(delete, 8))
+        self.assertEqual(sorted(tokenIds), sorted(tokenId for tokens in deleted for tokenId in tokens))
+        self.assertEqual({}, self.defaultUser.getAccessTokens())
+        for tokenId in tokenIds:
+            self.assertNotIn(tokenId, testObjects["accessTokens"])
+            self.assertIs(Missing, MainServer.lookupNode(f"{self.defaultUser.getPath()}/accessTokens/{tokenId}"))
+
+    def test_channel_and_customer_deletes_do_not_deadlock(self):
+        for round in range(20):
+            channel = Channel(f"deadlockChannel{round}", "Deadlock Channel")
+            customerIds = [channel.createChild(f"Deadlock Customer{number}") for number in range(8)]
+
+            errors = []
+
+            def deleteChannel():
+                try:
+                    ManagementServer.sendCommand("delete", f"channels/{channel.id}")
+                except Exception as error:
+                    errors.append(error)
+
+            def deleteCustomers():
+                try:
+                    for customerId in customerIds:
+                        MainServer.sendCommand("delete", f"customers/{customerId}")
+                except Exception as error:
+                    errors.append(error)
+
+            threads = [threading.Thread(target=target, daemon=True) for target in (deleteChannel, deleteCustomers)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join(timeout=10)
+                self.assertFalse(thread.is_alive())
+            self.assertEqual([], errors)
+            self.assertNotIn(channel.id, testObjects["channels"])
+            for customerId in customerIds:
+                self.assertNotIn(customerId, testObjects["customers"])
+                self.assertIs(Missing, MainServer.lookupNode(f"customers/{customerId}"))
+
+    def test_deletes_with_a_full_change_feed_do_not_deadlock(self):
+        tokenIds = [self.defaultUser.createChild(f"Feed Token{number}") for number in range(200)]
+        statuses = [[] for _ in range(4)]
+
+        def delete(number):
+            for tokenId in tokenIds[number % 2::2]:  # every token is deleted by two threads at once
+                response = MainServer.sendCommand("delete", f"{self.defaultUser.getPath()}/accessTokens/{tokenId}")
+                statuses[number].append(response["statusCode"])
+
+        maxPending, MainFeed.maxPending = MainFeed.maxPending, 1  # every publish waits for the replicator
+        MainFeed.start()
+        try:
+            threads = [threading.Thread(target=delete, args=(number,), daemon=True) for number in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join(timeout=10)
+                self.assertFalse(thread.is_alive())
+            self.assertTrue(MainFeed.waitFor(timeout=5))
+        finally:
+            MainFeed.stop()
+            MainFeed.maxPending = maxPending
+
+        codes = [code for codes in statuses for code in codes]
+        self.assertEqual(len(tokenIds), codes.count(200))  # a delete still waiting on the feed is not done twice
+        self.assertEqual(len(tokenIds), codes.count(404))
+        self.assertIsNone(MainFeed.lastError)
+        self.assertEqual({}, self.defaultUser.getAccessTokens())
+
+
+class test_snapshots(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.defaultUser = F_DEFAULT_USER()
+        self.tokenIds = [self.defaultUser.createChild(f"Snapshot Token{number}") for number in range(3)]
+
+    def test_snapshot_is_unchanged_by_later_writes(self):
+        userPath = self.defaultUser.getPath()
+        original = MainServer.sendCommand("get", userPath, {"snapshot": True})
+
+        self.defaultUser.deleteAccessToken(self.tokenIds[0])
+        newTokenId = self.defaultUser.createChild("Later Token")
+
+        self.assertEqual(200, original["statusCode"])
+        self.assertEqual(sorted(self.tokenIds), sorted(original["data"]["accessTokens"]))
+        self.assertNotIn(newTokenId, original["data"]["accessTokens"])
+        self.assertNotEqual(original["data"], MainServer.sendCommand("get", userPath)["data"])
+
+    def test_snapshot_reads_several_paths_at_one_version(self):
+        with MainServer.snapshot() as snapshot:
+            MainServer.sendCommand("delete", f"customers/{self.defaultUser.customerId}")
+
+            userResponse = MainServer.sendCommand("get", self.defaultUser.getPath(), {"snapshot": snapshot})
+            tokenResponse = snapshot.get(f"{self.defaultUser.getPath()}/accessTokens/{self.tokenIds[1]}")
+
+        self.assertEqual(404, MainServer.sendCommand("get", self.defaultUser.getPath())["statusCode"])
+        self.assertEqual(200, userResponse["statusCode"])
+        self.assertEqual({}, tokenResponse["data"])
+        self.assertNotIn(snapshot, MainServer.openSnapshots)
+
+
+class test_conditional_get(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.defaultUser = F_DEFAULT_USER()
+        self.usersPath = f"customers/{self.defaultUser.customerId}/users"
+
+    def test_unchanged_node_returns_not_modified(self):
+        first = MainServer.sendCommand("get", self.usersPath)
+        second = MainServer.sendCommand("get", self.usersPath, {"ifNoneMatch": first["version"]})
+
+        self.assertEqual(304, second["statusCode"])
+        self.assertEqual(first["version"], second["version"])
+        self.assertNotIn("users", second["data"])
+
+    def test_change_below_a_node_changes_its_version(self):
+        first = MainServer.sendCommand("get", self.usersPath)
+        customerVersion = MainServer.sendCommand("get", f"customers/{self.defaultUser.customerId}")["version"]
+        self.defaultUser.createChild("Conditional Token")
+
+        second = MainServer.sendCommand("get", self.usersPath, {"ifNoneMatch": first["version"]})
+        customer = MainServer.sendCommand("get", f"customers/{self.defaultUser.customerId}", {"ifNoneMatch": customerVersion})
+
+        self.assertEqual(200, second["statusCode"])
+        self.assertGreater(second["version"], first["version"])
+        self.assertEqual(200, customer["statusCode"])
+
+    def test_sibling_changes_do_not_change_a_node(self):
+        tokensPath = f"{self.defaultUser.getPath()}/accessTokens"
+        self.defaultUser.createChild("Conditional Token")
+        first = MainServer.sendCommand("get", tokensPath)
+        usersVersion = MainServer.sendCommand("get", self.usersPath)["version"]
+        testObjects["customers"][self.defaultUser.customerId].createChild("Other User")
+
+        self.assertEqual(304, MainServer.sendCommand("get", tokensPath, {"ifNoneMatch": first["version"]})["statusCode"])
+        self.assertEqual(200, MainServer.sendCommand("get", self.usersPath, {"ifNoneMatch": usersVersion})["statusCode"])
+
+
+class test_serialization(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.defaultUser = F_DEFAULT_USER()
+        self.encoder = ResponseEncoder(MainServer)
+        self.usersPath = f"customers/{self.defaultUser.customerId}/users"
+
+    def test_unchanged_node_reuses_encoded_bytes(self):
+        first = self.encoder.sendCommand("get", self.usersPath)
+        second = self.encoder.sendCommand("get", self.usersPath)
+
+        self.assertIs(first, second)
+        self.assertEqual(MainServer.sendCommand("get", self.usersPath)["data"], json.loads(second)["data"])
+        self.assertEqual(1, self.encoder.hits)
+
+    def test_change_below_a_node_encodes_it_again(self):
+        first = self.encoder.sendCommand("get", self.usersPath)
+        tokenId = self.defaultUser.createChild("Encoded Token")
+        second = self.encoder.sendCommand("get", self.usersPath)
+
+        self.assertNotEqual(first, second)
+        self.assertIn(tokenId, json.loads(second)["data"][self.defaultUser.id]["accessTokens"])
+        self.assertEqual(0, self.encoder.hits)
+
+    def test_least_recently_read_node_is_evicted(self):
+        userPath = self.defaultUser.getPath()
+        sizes = [len(ResponseEncoder(MainServer).sendCommand("get", path)) for path in (userPath, self.usersPath)]
+        self.encoder.maxBytes = sum(sizes) - 1
+        self.encoder.sendCommand("get", userPath)
+        self.encoder.sendCommand("get", self.usersPath)
+
+        self.assertNotIn(userPath, self.encoder.entries)
+        self.assertIn(self.usersPath, self.encoder.entries)
+        self.assertLessEqual(self.encoder.size, self.encoder.maxBytes)
+
+    def test_uncached_responses_are_still_encoded(self):
+        stream = json.loads(self.encoder.sendCommand("get", self.usersPath, {"stream": True}))
+        missing = json.loads(self.encoder.sendCommand("get", "customers/missing"))
+
+        self.assertIn(self.defaultUser.id, stream["data"])
+        self.assertEqual(404, missing["statusCode"])
+        self.assertEqual({}, self.encoder.entries)
+
+    def test_responses_without_a_version_are_encoded(self):
+        metrics = json.loads(self.encoder.sendCommand("get", "_metrics"))
+        query = json.loads(self.encoder.sendCommand("get", f"{self.usersPath}?name=User1"))
+
+        self.assertEqual(200, metrics["statusCode"])
+        self.assertEqual({self.defaultUser.id: "User1"}, query["data"])
+        self.assertEqual({}, self.encoder.entries)
+
+
+class test_http_front_end(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.defaultUser = F_DEFAULT_USER()
+        self.frontEnd = HttpFrontEnd(MainServer, workers=2)
+        self.address = self.frontEnd.start()
+        self.connection = HTTPConnection(*self.address)
+
+    def tearDown(self) -> None:
+        self.connection.close()
+        self.frontEnd.close()
+
+    def request(self, method: str, path: str, body: dict = None, headers: dict = None):
+        self.connection.request(method, path, json.dumps(body) if body is not None else None, headers or {})
+        response = self.connection.getresponse()
+        return response, response.read()
+
+    def test_get_matches_send_command(self):
+        response, body = self.request("GET", f"/{self.defaultUser.getPath()}")
+
+        self.assertEqual(200, response.status)
+        self.assertEqual(MainServer.sendCommand("get", self.defaultUser.getPath())["data"], json.loads(body)["data"])
+
+    def test_keep_alive_connection_serves_writes_and_conditional_gets(self):
+        tokensPath = f"/{self.defaultUser.getPath()}/accessTokens"
+        created, body = self.request("POST", tokensPath, {"name": "Http Token"})
+        tokenId = json.loads(body)["data"]
+        first, _ = self.request("GET", tokensPath)
+        notModified, notModifiedBody = self.request("GET", tokensPath, headers={"If-None-Match": first.getheader("ETag")})
+
+        self.assertEqual(200, created.status)
+        self.assertEqual("Http Token", testObjects["accessTokens"][tokenId].name)
+        self.assertEqual(304, notModified.status)
+        self.assertEqual(b"", notModifiedBody)
+
+    def test_pipelined_requests_are_answered_in_order(self):
+        paths = [self.defaultUser.getPath(), "customers/missing", self.defaultUser.getPath()]
+        with socket.create_connection(self.address) as connection:
+            connection.sendall(b"".join(f"GET /{path} HTTP/1.1\r\nHost: test\r\n\r\n".encode() for path in paths))
+            reader = connection.makefile("rb")
+            statuses = [readHttpResponse(reader) for _ in paths]
+
+        self.assertEqual([200, 404, 200], statuses)
+
+    def test_boolean_parameters(self):
+        tokensPath = f"/{self.defaultUser.getPath()}/accessTokens"
+        tokenId = self.defaultUser.createChild("Http Token")
+
+        unstreamed, body = self.request("GET", f"{tokensPath}?stream=false")
+        notBoolean, _ = self.request("GET", f"{tokensPath}?stream=maybe")
+        deleted, _ = self.request("DELETE", f"{tokensPath}/{tokenId}?background=0")
+
+        self.assertEqual(200, unstreamed.status)
+        self.assertEqual({tokenId: {}}, json.loads(body)["data"])
+        self.assertEqual(400, notBoolean.status)
+        self.assertEqual(200, deleted.status)  # answered once the delete is done rather than handed off with a 202
+
+    def test_bad_requests(self):
+        badBody, _ = self.request("PUT", f"/{self.defaultUser.getPath()}", {"title": "no name"})
+        missingParent, _ = self.request("POST", "/customers/missing/users", {"name": "User"})
+        userIds = set(testObjects["users"])
+        badName, _ = self.request("POST", f"/customers/{self.defaultUser.customerId}/users", {"name": 5})
+
+        self.assertEqual(400, badBody.status)
+        self.assertEqual(400, badName.status)
+        self.assertEqual(userIds, set(testObjects["users"]))  # nothing is left registered by a rejected post
+        self.assertEqual(404, missingParent.status)
+
+
+class test_queries(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.channel = F_DEFAULT_CHANNEL()
+        self.customers = [testObjects["customers"][self.channel.createChild(f"Query Customer {number}")] for number in range(4)]
+        self.channel.updateCustomerVersion(self.customers[2].id)
+        self.channel.updateCustomerVersion(self.customers[3].id)
+        self.channel.updateCustomerVersion(self.customers[3].id)
+
+    def test_version_range(self):
+        response = MainServer.sendCommand("get", "customers?version>=2")
+
+        self.assertEqual(200, response["statusCode"])
+        self.assertIn(self.customers[2].id, response["data"])
+        self.assertIn(self.customers[3].id, response["data"])
+        self.assertNotIn(self.customers[0].id, response["data"])
+        self.assertIn(self.customers[3].id, MainServer.sendCommand("get", "customers?version=3&name^=Query")["data"])
+
+    def test_name_prefix_within_a_node(self):
+        customer = self.customers[0]
+        userIds = [customer.createChild(name) for name in ("abbot", "abacus", "baker")]
+        otherUserId = self.customers[1].createChild("abigail")
+
+        inCustomer = MainServer.sendCommand("get", f"customers/{customer.id}/users?name^=ab")
+        everywhere = MainServer.sendCommand("get", "users?name^=ab")
+
+        self.assertEqual({userIds[0]: "abbot", userIds[1]: "abacus"}, inCustomer["data"])
+        self.assertIn(otherUserId, everywhere["data"])
+        self.assertNotIn(userIds[2], everywhere["data"])
+
+    def test_indexes_follow_renames_and_deletes(self):
+        customer = self.customers[1]
+        MainServer.sendCommand("put", f"customers/{customer.id}", {"name": "Renamed Query Customer"})
+        self.assertEqual({customer.id: "Renamed Query Customer"}, MainServer.sendCommand("get", "customers?name=Renamed Query Customer")["data"])
+        self.assertNotIn(customer.id, MainServer.sendCommand("get", "customers?name=Query Customer 1")["data"])
+
+        self.channel.deleteCustomer(customer.id)
+        self.assertEqual({}, MainServer.sendCommand("get", "customers?name=Renamed Query Customer")["data"])
+
+    def test_names_that_are_not_strings_are_rejected(self):
+        customerIds = set(testObjects["customers"])
+        customer = self.customers[0]
+
+        created = ManagementServer.sendCommand("post", "customers", {"from": self.channel, "name": 5})
+        renamed = MainServer.sendCommand("put", f"customers/{customer.id}", {"name": None})
+
+        self.assertEqual(400, created["statusCode"])
+        self.assertEqual(customerIds, set(testObjects["customers"]))
+        self.assertEqual(400, renamed["statusCode"])
+        self.assertEqual("Query Customer 0", customer.name)
+        self.assertIn(customer.id, MainServer.sendCommand("get", "customers?name=Query Customer 0")["data"])
+
+    def test_invalid_queries(self):
+        self.assertEqual(400, MainServer.sendCommand("get", "customers?colour=red")["statusCode"])
+        self.assertEqual(400, MainServer.sendCommand("get", "customers?version>=new")["statusCode"])
+        self.assertEqual(400, MainServer.sendCommand("get", "customers?version")["statusCode"])
+        self.assertEqual(404, MainServer.sendCommand("get", "customers/missing/users?name=a")["statusCode"])
+
+    def test_query_results_can_be_paged(self):
+        collected = {}
+        cursor = None
+        while True:
+            response = MainServer.sendCommand("get", "customers?version>=2&name^=Query", {"limit": 2, "cursor": cursor})
+            collected.update(response["data"]["items"])
+            cursor = response["data"]["cursor"]
+            if cursor is None:
+                break
+
+        self.assertEqual(MainServer.sendCommand("get", "customers?version>=2&name^=Query")["data"], collected)
+        self.assertEqual(400, MainServer.sendCommand("get", "customers?version>=2", {"limit": 0})["statusCode"])
+
+    def test_query_over_http(self):
+        frontEnd = HttpFrontEnd(MainServer, workers=1)
+        connection = HTTPConnection(*frontEnd.start())
+        try:
+            connection.request("GET", "/customers?version%3E=3")
+            response = json.loads(connection.getresponse().read())
+        finally:
+            connection.close()
+            frontEnd.close()
+
+        self.assertIn(self.customers[3].id, response["data"])
+        self.assertNotIn(self.customers[2].id, response["data"])
+
+
+class test_version_rollout(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.channel = Channel("rolloutChannel", "rolloutChannel")
+        self.customerIds = [self.channel.createChild(f"Rollout Customer {number}") for number in range(40)]
+
+    def versions(self) -> list[int]:
+        return [testObjects["customers"][customerId].version for customerId in self.customerIds]
+
+    def test_whole_channel_rollout(self):
+        otherCustomer = testObjects["customers"][F_DEFAULT_CUSTOMER().id]
+
+        self.assertEqual(40, self.channel.updateCustomerVersions())
+        self.assertEqual([2] * 40, self.versions())
+        self.assertEqual(1, otherCustomer.version)
+        self.assertEqual({2: 40}, self.channel.getVersionHistogram())
+
+        self.channel.downgradeCustomerVersion(self.customerIds[0])
+        self.assertEqual({1: 1, 2: 39}, self.channel.getVersionHistogram())
+
+    def test_filtered_and_percentage_cohorts(self):
+        self.channel.updateCustomerVersion(self.customerIds[0])
+        self.assertEqual(1, self.channel.updateCustomerVersions(fromVersion=2))
+        self.assertEqual({1: 39, 3: 1}, self.channel.getVersionHistogram())
+
+        firstWave = self.channel.updateCustomerVersions(fromVersion=1, percentage=25)
+        quarter = {customerId for customerId, version in zip(self.customerIds, self.versions()) if version == 2}
+        self.channel.updateCustomerVersions(fromVersion=1, percentage=50)
+        half = {customerId for customerId, version in zip(self.customerIds, self.versions()) if version == 2}
+
+        self.assertTrue(0 < firstWave < 39)
+        self.assertTrue(quarter < half)
+        self.assertEqual(3, self.versions()[0])
+
+    def test_rollout_is_visible_to_queries(self):
+        self.channel.updateCustomerVersions()
+        self.channel.updateCustomerVersions(fromVersion=2, percentage=50)
+
+        upgraded = MainServer.sendCommand("get", "customers?version>=3")["data"]
+        expected = {customerId for customerId, version in zip(self.customerIds, self.versions()) if version >= 3}
+        self.assertEqual(expected, expected & upgraded.keys())
+        self.assertFalse((set(self.customerIds) - expected) & upgraded.keys())
+
+    def test_deleted_customers_leave_the_channel(self):
+        self.channel.deleteCustomer(self.customerIds[0])
+
+        self.assertEqual(39, self.channel.updateCustomerVersions())
+        self.assertEqual({2: 39}, self.channel.getVersionHistogram())
+
+    def test_column_without_numpy(self):
+        with mock.patch("columns.numpy", None):
+            column = VersionColumn(2)
+            code = column.channelCode()
+            rows = [column.allocate(f"customer{number}", 1) for number in range(5)]
+            for row in rows[:4]:
+                column.assignChannel(row, code)
+            column.free(rows[0])
+
+            self.assertEqual(3, column.rollout(1, code))
+            self.assertEqual({1: 1, 2: 3}, column.histogram())
+            self.assertEqual(["customer4"], list(column.find("<", 2)))
+
+    def test_channels_assigned_while_the_column_grows_are_kept(self):
+        column = VersionColumn(2)
+        code = column.channelCode()
+        switchInterval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+
+        def assign():
+            for number in range(500):
+                column.assignChannel(column.allocate(f"customer{number}", 1), code)
+
+        threads = [threading.Thread(target=assign) for _ in range(4)]
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            sys.setswitchinterval(switchInterval)
+
+        self.assertEqual(2000, len(column.cohort(code)))
+
+    @staticmethod
+    def exercise_column():
+        column = VersionColumn(2)
+        code = column.channelCode()
+        rows = [column.allocate(f"customer{number}", number % 3 + 1) for number in range(30)]
+        for row in rows[:20]:
+            column.assignChannel(row, code)
+        column.free(rows[0])
+        moved = [column.rollout(1, code, fromVersion=2), column.rollout(1, code, percentage=40)]
+        return column, moved, column.histogram(code), column.histogram(), sorted(column.find(">=", 3)), sorted(column.find("=", 1))
+
+    @unittest.skipIf(numpy is None, "numpy is not installed")
+    def test_numpy_column_matches_plain_arrays(self):
+        column, *results = self.exercise_column()
+        with mock.patch("columns.numpy", None):
+            plainColumn, *plainResults = self.exercise_column()
+
+        self.assertIsInstance(column.versions, numpy.ndarray)
+        self.assertNotIsInstance(plainColumn.versions, numpy.ndarray)
+        self.assertEqual(plainResults, results)
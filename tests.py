@@ -1,4 +1,3 @@
-from copy import deepcopy
 from objects import MainServer, ManagementServer, Channel, Schema
 from databaseObjects import testObjects
 
@@ -49,8 +48,8 @@ def test_update_channels():  # here we check we can update a channel
 def test_delete_access_token():  # here we check we delete an access token
     # in this test we:
     # get the existing access tokens
-    original = deepcopy(MainServer.sendCommand("get", f"customers/{F_DEFAULT_CUSTOMER.id}/users/{F_DEFAULT_USER.id}"))
-    # due to the nature of these being mock up tests we require a deep copy of the delete to avoid updating it later
+    original = MainServer.sendCommand("get", f"customers/{F_DEFAULT_CUSTOMER.id}/users/{F_DEFAULT_USER.id}", {"snapshot": True})
+    # we ask for a snapshot so the original response is not changed by the delete later
     # delete the access token
     response = MainServer.sendCommand("delete", f"customers/{F_DEFAULT_CUSTOMER.id}/users/{F_DEFAULT_USER.id}/accessTokens/{F_DEFAULT_ACCESS_TOKEN.id}")
     # check the response schema is correct and check it has been deleted